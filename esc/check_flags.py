@@ -1,24 +1,21 @@
 #!/usr/bin/env python3
 
 import hashlib
-import re
-from ck2parser import rootpath, vanilladir, is_codename, SimpleParser
+from ck2parser import rootpath, vanilladir, SimpleParser
 from print_time import print_time
 
+TITLE_PREFIXES = ['e_', 'k_', 'd_', 'c_', 'b_']
+
 
 @print_time
 def main():
     parser = SimpleParser(rootpath / 'SWMH-BETA/SWMH')
     placeholder_md5 = '5c9d144af032f709172c564dc1d641b9'
     titles = []
-    for _, tree in parser.parse_files('common/landed_titles/*.txt'):
-        dfs = list(reversed(tree))
-        while dfs:
-            n, v = dfs.pop()
-            if is_codename(n.val):
-                if n.val not in titles:
-                    titles.append(n.val)
-                dfs.extend(reversed(v))
+    for path in parser.files('common/landed_titles/*.txt'):
+        for title in parser.nested_keys(path, TITLE_PREFIXES):
+            if title not in titles:
+                titles.append(title)
     no_title = []
     placeholders = []
     for path in parser.files('gfx/flags/*.tga'):
@@ -35,27 +35,41 @@ def check_title(parser, v, path, titles, lhs=False, line=None):
         return False
     return True
 
-def check_titles(parser, path, titles):
-    def recurse(tree):
-        if tree.has_pairs:
-            for p in tree:
-                n, v = p
-                v_is_obj = isinstance(v, Obj)
-                check_title(parser, n, path, titles, v_is_obj, p)
-                if v_is_obj:
-                    recurse(v)
-                else:
-                    check_title(parser, v, path, titles, line=p)
-        else:
-            for v in tree:
-                check_title(parser, v, path, titles, line=v)
+# every value check_title may be given for a file, as (value, lhs, line)
+# with line the node it reports
+def ref_spots(tree):
+    if tree.has_pairs:
+        for p in tree:
+            n, v = p
+            v_is_obj = isinstance(v, Obj)
+            yield n, v_is_obj, p
+            if v_is_obj:
+                yield from ref_spots(v)
+            else:
+                yield v, False, p
+    else:
+        for v in tree:
+            yield v, False, v
 
+# every codename a file refers to, as (lhs, codename, i) with i its place in
+# ref_spots, so the line is only rendered for a codename that turns out bad
+def title_refs(parser, path, tree):
     try:
-        recurse(parser.parse_file(path))
+        return [(lhs, v.val, i)
+                for i, (v, lhs, _) in enumerate(ref_spots(tree))
+                if is_codename(v.val)]
     except:
         print(path)
         raise
 
+def check_titles(parser, path, titles, refs):
+    misses = [(lhs, i) for lhs, title, i in refs if title not in titles]
+    if misses:
+        spots = list(ref_spots(parser.parse_file(path)))
+        for lhs, i in misses:
+            v, _, line = spots[i]
+            check_title(parser, v, path, titles, lhs, line)
+
 def check_regions(parser, titles, duchies_de_jure):
     bad_titles = []
     missing_duchies = list(duchies_de_jure)
@@ -86,36 +100,62 @@ def check_regions(parser, titles, duchies_de_jure):
 
 def check_province_history(parser, titles):
     id_name_map = get_province_id_name_map(parser)
+    paths = []
     for path in parser.files('history/provinces/*.txt'):
         number, name = path.stem.split(' - ')
         if id_name_map.get(int(number)) == name:
-            check_titles(parser, path, titles)
+            paths.append(path)
+    for path, refs in parser.path_facts('title_ref_spots', paths,
+                                        title_refs):
+        check_titles(parser, path, titles, refs)
+
+# each title a landed_titles file defines, in order, as (title, misogynous,
+# de jure vassals)
+def landed_title_facts(parser, path, tree):
+    facts = []
+    try:
+        dfs = list(reversed(tree))
+        while dfs:
+            n, v = dfs.pop()
+            if is_codename(n.val):
+                misogynous = bool(v.get('title') and not v.get('title_female'))
+                vassals = [n2.val for n2, v2 in v if is_codename(n2.val)]
+                facts.append((n.val, misogynous, vassals))
+                dfs.extend(reversed(v))
+    except:
+        print(path)
+        raise
+    return facts
 
 def process_landed_titles(parser):
     titles_list = []
     title_liege_map = {}
     title_vassals_map = defaultdict(set)
     misogyny = []
-    for path, tree in parser.parse_files('common/landed_titles/*.txt'):
-        try:
-            dfs = list(reversed(tree))
-            while dfs:
-                n, v = dfs.pop()
-                if is_codename(n.val):
-                    if n.val not in titles_list:
-                        titles_list.append(n.val)
-                    if v.get('title') and not v.get('title_female'):
-                        misogyny.append(n.val)
-                    for n2, v2 in v:
-                        if is_codename(n2.val):
-                            title_liege_map[n2.val] = n.val
-                            title_vassals_map[n.val].add(n2.val)
-                    dfs.extend(reversed(v))
-        except:
-            print(path)
-            raise
+    seen = set()
+    for path, facts in parser.file_facts(
+            'landed_titles', 'common/landed_titles/*.txt', landed_title_facts):
+        for title, misogynous, vassals in facts:
+            if title not in seen:
+                seen.add(title)
+                titles_list.append(title)
+            if misogynous:
+                misogyny.append(title)
+            for vassal in vassals:
+                title_liege_map[vassal] = title
+                title_vassals_map[title].add(vassal)
     return titles_list, title_liege_map, title_vassals_map, misogyny
 
+# whether a title history file has contents, the codenames it refers to, and
+# its de jure liege changes in date order
+def title_history_facts(parser, path, tree):
+    changes = []
+    for n, v in sorted(tree, key=attrgetter('key.val')):
+        for n2, v2 in v:
+            if n2.val == 'de_jure_liege':
+                changes.append((n.val, v2.val))
+    return bool(tree.contents), title_refs(parser, path, tree), changes
+
 @print_time
 def main():
     # import pdb
@@ -127,9 +167,10 @@ def main():
     titles = set(titles_list)
     check_province_history(parser, titles)
     start_date = parser.parse_file('common/defines.txt')['start_date'].val
-    for path, tree in parser.parse_files('history/titles/*.txt',
-                                         memcache=True):
-        if tree.contents:
+    for path, (has_contents, refs, changes) in parser.file_facts(
+            'title_history_refs', 'history/titles/*.txt',
+            title_history_facts):
+        if has_contents:
             title = path.stem
             good = check_title(parser, title, path, titles)
             if (VANILLA_HISTORY_WARN and not good and
@@ -139,25 +180,24 @@ def main():
                 print('Should override {} with blank file'.format(
                       '<vanilla>' / path.relative_to(vanilladir)))
             else:
-                check_titles(parser, path, titles)
+                check_titles(parser, path, titles, refs)
             # update de jure changed before start_date
-            for n, v in sorted(tree, key=attrgetter('key.val')):
-                if n.val > start_date:
+            for date, liege in changes:
+                if date > start_date:
                     break
-                for n2, v2 in v:
-                    if n2.val == 'de_jure_liege':
-                        old_liege = title_liege_map.get(title)
-                        if old_liege:
-                            title_vassals_map[old_liege].discard(title)
-                        title_liege_map[title] = v2.val
-                        title_vassals_map[v2.val].add(title)
-        parser.flush(path)
+                old_liege = title_liege_map.get(title)
+                if old_liege:
+                    title_vassals_map[old_liege].discard(title)
+                title_liege_map[title] = liege
+                title_vassals_map[liege].add(title)
     duchies_de_jure = [t for t, v in title_vassals_map.items()
                        if t[0] == 'd' and v]
     bad_region_titles, missing_duchies = check_regions(parser, titles,
                                                        duchies_de_jure)
-    for _ in parser.parse_files('history/characters/*.txt'):
-        pass # just parse it to see if it parses
+    # just parse it to see if it parses
+    for _ in parser.file_facts('parses', 'history/characters/*.txt',
+                               lambda parser, path, tree: None):
+        pass
     globs = [
         'events/*.txt',
         'decisions/*.txt',
@@ -173,8 +213,9 @@ def main():
         'common/achievements.txt'
         ]
     for glob in globs:
-        for path in parser.files(glob):
-            check_titles(parser, path, titles)
+        for path, refs in parser.file_facts('title_ref_spots', glob,
+                                            title_refs):
+            check_titles(parser, path, titles, refs)
     with (rootpath / 'check_titles.txt').open('w') as fp:
         if bad_region_titles:
             print('Titular titles in regions:\n\t', end='', file=fp)
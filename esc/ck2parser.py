@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
+import array
+import atexit
+import codecs
 import collections
+import concurrent.futures
+import contextlib
 import csv
 import functools
+import gc
 import hashlib
+import io
+import mmap
 import operator
 import os
 import pathlib
 import pickle
+import queue
 import re
+import sqlite3
+import struct
 import sys
+import threading
 import time
 import traceback
-from funcparserlib.lexer import make_tokenizer, Token
+from funcparserlib.lexer import make_tokenizer, Token, LexerError
 from funcparserlib.parser import (some, a, maybe, many, finished, skip,
                                   oneplus, forward_decl, NoParseError)
 from localpaths import rootpath, vanilladir, cachedir
@@ -23,7 +35,7 @@ try:
 except ImportError:
     git_present = False
 
-VERSION = 3
+VERSION = 8
 
 csv.register_dialect('ckii', delimiter=';', doublequote=False,
                      quotechar='\0', quoting=csv.QUOTE_NONE, strict=True)
@@ -96,12 +108,262 @@ def get_provinces(parser):
             yield number, title, tree
 
 def get_localisation(moddirs=(), basedir=vanilladir, ordered=False):
-    locs = collections.OrderedDict() if ordered else {}
-    for path in files('localisation/*.csv', moddirs, basedir=basedir):
-        for row in csv_rows(path):
-            if row[0] not in locs:
-                locs[row[0]] = row[1]
-    return locs
+    return get_localisation_index(moddirs, basedir).dict(ordered=ordered)
+
+# every row of the localisation files of a base dir and mod dirs, kept in a
+# database per mod stack. a key's value is its first row in files order, as
+# in get_localisation; the rows it overrides are kept for provenance. refresh
+# rereads only the files whose size, mtime or inode changed.
+class LocalisationIndex:
+    schema_version = 1
+    # the csv column of each language
+    languages = {'english': 1, 'french': 2, 'german': 3, 'spanish': 5}
+    mmap_size = 1 << 28
+
+    def __init__(self, moddirs=(), basedir=vanilladir):
+        self.moddirs = list(moddirs)
+        self.basedir = basedir
+        m = hashlib.md5()
+        m.update(str(self.schema_version).encode())
+        for d in [basedir] + self.moddirs:
+            m.update(bytes(d.resolve()) + b'\0')
+        self.path = cachedir / 'localisation' / (m.hexdigest() + '.sqlite')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=60)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('PRAGMA mmap_size = {}'.format(self.mmap_size))
+        values = ', '.join(l + ' TEXT' for l in self.languages)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS files (id INTEGER '
+                            'PRIMARY KEY, path TEXT UNIQUE, rank INTEGER, '
+                            'size INTEGER, mtime_ns INTEGER, ino INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (file '
+                            'INTEGER, line INTEGER, key TEXT, {})'.format(
+                            values))
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_key ON '
+                            'entries (key)')
+            # the row that counts for each key
+            self.db.execute('CREATE TABLE IF NOT EXISTS winners (file '
+                            'INTEGER, line INTEGER, key TEXT UNIQUE, '
+                            '{})'.format(values))
+
+    # brings the database up to date with the files, and returns how many
+    # were read
+    def refresh(self):
+        paths = list(files('localisation/*.csv', self.moddirs,
+                           basedir=self.basedir))
+        known = {path: (id, rank, signature)
+                 for id, path, rank, *signature in self.db.execute(
+                     'SELECT id, path, rank, size, mtime_ns, ino FROM files')}
+        columns = list(self.languages.values())
+        insert = 'INSERT INTO entries VALUES ({})'.format(
+            ', '.join('?' * (3 + len(columns))))
+        # keys whose winner may have changed. files that stay keep their
+        # order relative to each other, so only rows read or dropped count.
+        touched = set()
+        read = 0
+        with self.db:
+            for rank, path in enumerate(paths):
+                st = path.stat()
+                signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+                id, old_rank, old_signature = known.pop(str(path),
+                                                        (None, None, None))
+                if id is not None and old_signature == signature:
+                    if old_rank != rank:
+                        self.db.execute('UPDATE files SET rank = ? WHERE '
+                                        'id = ?', (rank, id))
+                    continue
+                if id is not None:
+                    self.forget(id, touched)
+                id = self.db.execute(
+                    'INSERT INTO files (path, rank, size, mtime_ns, ino) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [str(path), rank] + signature).lastrowid
+                rows = list(csv_rows(path, linenum=True))
+                touched.update(row[0] for row, _ in rows)
+                self.db.executemany(insert, (
+                    [id, linenum, row[0]] +
+                    [row[i] if i < len(row) else None for i in columns]
+                    for row, linenum in rows))
+                read += 1
+            for id, *_ in known.values():
+                self.forget(id, touched)
+            if touched:
+                self.update_winners(touched)
+        return read
+
+    def forget(self, id, touched):
+        touched.update(key for key, in self.db.execute(
+            'SELECT key FROM entries WHERE file = ?', (id,)))
+        self.db.execute('DELETE FROM entries WHERE file = ?', (id,))
+        self.db.execute('DELETE FROM files WHERE id = ?', (id,))
+
+    # rows go in in files order, so the first for each key is the one kept
+    def update_winners(self, keys):
+        if not self.db.execute('SELECT 1 FROM winners LIMIT 1').fetchone():
+            self.db.execute('INSERT OR IGNORE INTO winners SELECT entries.* '
+                            'FROM entries JOIN files ON file = id ORDER BY '
+                            'rank, line')
+            return
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS touched (key TEXT '
+                        'PRIMARY KEY)')
+        self.db.execute('DELETE FROM touched')
+        self.db.executemany('INSERT INTO touched VALUES (?)',
+                            ((key,) for key in keys))
+        self.db.execute('DELETE FROM winners WHERE key IN touched')
+        self.db.execute('INSERT OR IGNORE INTO winners SELECT entries.* FROM '
+                        'entries JOIN files ON file = id WHERE key IN touched '
+                        'ORDER BY rank, line')
+
+    # languages go into queries as column names, so only known ones will do
+    def column(self, language):
+        if language not in self.languages:
+            raise ValueError('unknown language {}'.format(language))
+        return language
+
+    # (key, value, path, line) of every row, in files order and then line
+    # order, so a key's first row is the one that counts
+    def rows(self, language='english'):
+        for key, value, path, line in self.db.execute(
+                'SELECT key, {}, path, line FROM entries JOIN files ON '
+                'file = id ORDER BY rank, line'.format(
+                    self.column(language))):
+            yield key, value, pathlib.Path(path), line
+
+    # (value, path, line) of each row for key, the one that counts first
+    def definitions(self, key, language='english'):
+        return [(value, pathlib.Path(path), line)
+                for value, path, line in self.db.execute(
+                    'SELECT {}, path, line FROM entries JOIN files ON '
+                    'file = id WHERE key = ? ORDER BY rank, line'.format(
+                        self.column(language)), (key,))]
+
+    def get(self, key, default=None, language='english'):
+        row = self.db.execute('SELECT {} FROM winners WHERE key = ?'.format(
+                              self.column(language)), (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def __getitem__(self, key):
+        row = self.db.execute('SELECT english FROM winners WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __contains__(self, key):
+        return self.db.execute('SELECT 1 FROM winners WHERE key = ?',
+                               (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM winners').fetchone()[0]
+
+    # (key, value) for each key starting with prefix, in key order
+    def prefixed(self, prefix, language='english'):
+        # every string starting with prefix sorts below this
+        end = prefix + '\U0010ffff'
+        return self.db.execute(
+            'SELECT key, {} FROM winners WHERE key >= ? AND key < ? ORDER BY '
+            'key'.format(self.column(language)), (prefix, end))
+
+    # the values that count, as get_localisation returns them. ordered, they
+    # are in the order of their rows in the files.
+    def dict(self, language='english', ordered=False):
+        column = self.column(language)
+        if not ordered:
+            return dict(self.db.execute('SELECT key, {} FROM '
+                                        'winners'.format(column)))
+        return collections.OrderedDict(self.db.execute(
+            'SELECT key, {} FROM winners JOIN files ON file = id ORDER BY '
+            'rank, line'.format(column)))
+
+localisation_indexes = {}
+
+# the index for the dirs, refreshed on each call
+def get_localisation_index(moddirs=(), basedir=vanilladir):
+    dirs = (basedir,) + tuple(moddirs)
+    try:
+        index = localisation_indexes[dirs]
+    except KeyError:
+        index = localisation_indexes[dirs] = LocalisationIndex(moddirs,
+                                                               basedir)
+    index.refresh()
+    return index
+
+# derived data that most scripts start from, for a parser's base and mod
+# dirs. get_game_model keeps it on disk until one of the files it was read
+# from changes.
+class GameModel:
+    # part of the cache key, so bump it whenever the fields change
+    schema_version = 1
+    # globs covering every file the model is read from
+    sources = ['common/landed_titles/*.txt', 'common/cultures/*.txt',
+               'common/religions/*.txt', 'map/default.map', 'map/*.csv',
+               'history/provinces/* - *.txt', 'localisation/*.csv']
+
+    def __init__(self, parser):
+        self.titles = [] # every title codename, in landed_titles order
+        self.title_liege = {} # de jure liege per landed_titles
+        for _, tree in parser.parse_files('common/landed_titles/*.txt'):
+            dfs = [(None, pair) for pair in reversed(tree.contents)]
+            while dfs:
+                liege, (n, v) = dfs.pop()
+                if is_codename(n.val) and isinstance(v, Obj):
+                    if n.val not in self.title_liege:
+                        self.titles.append(n.val)
+                    self.title_liege[n.val] = liege
+                    dfs.extend((n.val, pair) for pair in reversed(v.contents)
+                               if isinstance(pair, Pair))
+        self.cultures, self.culture_groups = get_cultures(parser)
+        self.religions, self.religion_groups = get_religions(parser)
+        self.province_id_name = get_province_id_name_map(parser)
+        self.province_title = {}
+        for path in parser.files('history/provinces/* - *.txt'):
+            number, name = path.stem.split(' - ')
+            number = int(number)
+            if self.province_id_name.get(number) == name:
+                title = parser.parse_file(path, lazy=True).get('title')
+                if title is not None:
+                    self.province_title[number] = title.val
+        self.localisation = get_localisation(parser.moddirs,
+                                             basedir=parser.basedir)
+
+    @property
+    def title_vassals(self):
+        vassals = collections.defaultdict(list)
+        for title in self.titles:
+            liege = self.title_liege[title]
+            if liege is not None:
+                vassals[liege].append(title)
+        return vassals
+
+# identifies the mod stack and the size, mtime and inode of every file a
+# GameModel would read, without reading any of them
+def game_model_fingerprint(parser):
+    m = hashlib.md5()
+    m.update('{}\0{}\0'.format(VERSION, GameModel.schema_version).encode())
+    for d in [parser.basedir] + list(parser.moddirs):
+        m.update(bytes(d.resolve()) + b'\0')
+    for glob in GameModel.sources:
+        for path in parser.files(glob):
+            st = path.stat()
+            m.update(bytes(path) + '\0{}\0{}\0{}\0'.format(
+                st.st_size, st.st_mtime_ns, st.st_ino).encode())
+    return m.hexdigest()
+
+def get_game_model(parser):
+    path = cachedir / 'models' / game_model_fingerprint(parser)
+    try:
+        with path.open('rb') as f, gc_paused():
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError, AttributeError):
+        pass
+    model = GameModel(parser)
+    try:
+        write_atomic(path, pickle.dumps(model, pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass
+    return model
 
 def first_post_comment(item):
     if item.post_comment:
@@ -120,8 +382,60 @@ def is_codename(string):
     except TypeError:
         return False
 
+def str_to_number(string):
+    try:
+        return int(string)
+    except ValueError:
+        return float(string)
+
+def str_to_date(string):
+    return tuple((int(x) if x else 0) for x in string.split('.'))
+
+# a key's value as the parsers would read it
+def str_to_key(string):
+    if re.fullmatch(r'-?\d*\.\d*\.\d*', string):
+        return str_to_date(string)
+    if re.fullmatch(r'-?\d+(\.\d+)?', string):
+        return str_to_number(string)
+    return string
+
+# parse trees are acyclic, so the cyclic collector has nothing to find in
+# them; left on, it rescans every live node each time a generation fills up.
+@contextlib.contextmanager
+def gc_paused():
+    if gc.isenabled():
+        gc.disable()
+        try:
+            yield
+        finally:
+            gc.enable()
+    else:
+        yield
+
+# a read-only mapping of the file, or b'' for an empty one, which can't be
+# mapped
+@contextlib.contextmanager
+def mapped(path):
+    with open(str(path), 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b''
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield data
+    finally:
+        try:
+            data.close()
+        except BufferError:
+            # a scan left unfinished by an exception still holds the mapping,
+            # which is unmapped once the scan is collected
+            pass
+
 def chars(line, parser):
     line = str(line)
+    # no tabs or line breaks
+    if line.isprintable():
+        return len(line)
     try:
         line = line.splitlines()[-1]
     except IndexError: # empty string
@@ -134,40 +448,195 @@ def chars(line, parser):
             col += 1
     return col
 
+# the numbers of leading lines that might parse as script, longest first. a
+# single pass over the tokens of each line follows a looser grammar than
+# either parser's, so every prefix left out would fail to parse, or would
+# parse to nothing; tokens never span lines, so no line is tokenized twice.
+def script_prefix_candidates(parser, lines):
+    keys = {'Name', 'Date', 'Number', 'String',
+            'unquoted_string', 'date', 'number', 'quoted_string'}
+    candidates = []
+    depth = 0
+    # 'key', 'op' and 'value' for a pair at the top level or after an op,
+    # 'item' and 'item_or_op' for the contents of an object
+    expect = 'key'
+    has_pairs = False
+    try:
+        for k, line in enumerate(lines, 1):
+            for type, value in parser.tokenizer.tokenize(line):
+                if type in ('comment', 'newline'):
+                    continue
+                if expect == 'key' and type in keys:
+                    expect = 'op'
+                elif expect == 'op' and type in ('Op', 'op'):
+                    expect = 'value'
+                elif expect == 'item_or_op' and type in ('Op', 'op'):
+                    expect = 'value'
+                elif expect != 'op' and type in keys:
+                    if expect == 'value' and not depth:
+                        expect = 'key'
+                        has_pairs = True
+                    else:
+                        expect = 'item_or_op'
+                elif expect != 'op' and value == '{':
+                    depth += 1
+                    expect = 'item'
+                elif expect in ('item', 'item_or_op') and value == '}':
+                    depth -= 1
+                    if depth:
+                        expect = 'item'
+                    else:
+                        expect = 'key'
+                        has_pairs = True
+                else:
+                    return candidates[::-1]
+            if parser.strict:
+                if not depth and expect == 'key' and has_pairs:
+                    candidates.append(k)
+            elif has_pairs or depth:
+                candidates.append(k)
+    except LexerError:
+        pass
+    return candidates[::-1]
+
+# how many leading lines of comments parse as script with some contents, and
+# their tree if it was parsed just now. memoized per parser by the text.
+def script_prefix(parser, comments):
+    lines = [c.val for c in comments]
+    text = '\n'.join(lines)
+    try:
+        return parser.script_prefixes[text], None
+    except KeyError:
+        pass
+    k, tree = 0, None
+    for candidate in script_prefix_candidates(parser, lines):
+        try:
+            tree = parser.parse('\n'.join(lines[:candidate]))
+        except (NoParseError, LexerError):
+            continue
+        if tree.contents:
+            k = candidate
+            break
+    parser.script_prefixes[text] = k
+    return k, tree
+
+# the longest run of leading comments that parses as script is written out
+# as commented-out script, and the rest as they are
 def comments_to_str(parser, comments, indent):
-    s = ''
-    if indent == 0 and comments and comments[0].val.startswith('-*-'):
-        s = str(comments[0]) + '\n\n'
-        comments = comments[1:]
-    if not comments:
-        return s
     indent_str = '\t' if parser.tab_indents else ' ' * parser.indent_width
     sep = '\n' + indent * indent_str
-    comments_str = '\n'.join(c.val for c in comments)
-    if comments_str == '':
-        return s
-    try:
-        tree = parser.parse(comments_str)
-        if not tree.contents:
-            raise ValueError()
-    except (NoParseError, ValueError):
-        butlast = comments_to_str(parser, comments[:-1], indent)
-        if butlast:
-            butlast += indent * indent_str
-        return s + butlast + str(comments[-1]) + '\n'
-    for p in tree:
-        p_is, _ = p.inline_str(parser, indent)
-        p_is_lines = p_is.rstrip().splitlines()
-        s += '#' + p_is_lines[0] + sep
-        s += ''.join('#' + line[len(sep) - 1:] + sep
-                     for line in p_is_lines[1:])
-    if tree.post_comments:
-        s += comments_to_str(parser, tree.post_comments, indent)
-    s = s.rstrip('\t ')
-    return s
+    # from the end back to the script, the comment at each step and the
+    # header split off before it
+    tails = []
+    end = len(comments)
+    k = None
+    while True:
+        s = ''
+        if indent == 0 and end and comments[0].val.startswith('-*-'):
+            s = str(comments[0]) + '\n\n'
+            comments = comments[1:end]
+            end -= 1
+            k = None
+        if not end or end == 1 and comments[0].val == '':
+            result = s
+            break
+        if k is None:
+            k, tree = script_prefix(parser, comments[:end])
+        if end == k:
+            if tree is None:
+                tree = parser.parse('\n'.join(c.val for c in comments[:k]))
+            for p in tree:
+                p_is, _ = p.inline_str(parser, indent)
+                p_is_lines = p_is.rstrip().splitlines()
+                s += '#' + p_is_lines[0] + sep
+                s += ''.join('#' + line[len(sep) - 1:] + sep
+                             for line in p_is_lines[1:])
+            if tree.post_comments:
+                s += comments_to_str(parser, tree.post_comments, indent)
+            result = s.rstrip('\t ')
+            break
+        end -= 1
+        tails.append((s, comments[end]))
+    for s, comment in reversed(tails):
+        if result:
+            result += indent * indent_str
+        result = s + result + str(comment) + '\n'
+    return result
+
+
+# raised when something is written to a TextWriter in oneline mode that
+# would start a new line
+class LineBroken(Exception):
+    pass
+
+# the text of a tree as it's written out, as a list of pieces. nodes append
+# to it, look at or take back its last few characters, and roll it back to a
+# mark to drop an attempted layout, without copying anything before them.
+# while oneline is set, writing a newline raises LineBroken, so an attempt
+# to fit an object on one line stops at the first line break.
+class TextWriter:
+    __slots__ = ['parts', 'oneline']
+
+    def __init__(self):
+        self.parts = []
+        self.oneline = False
+
+    def write(self, string):
+        if string:
+            if self.oneline and '\n' in string:
+                raise LineBroken()
+            self.parts.append(string)
+
+    def mark(self):
+        return len(self.parts)
+
+    def rollback(self, mark):
+        del self.parts[mark:]
+
+    def since(self, mark):
+        return ''.join(self.parts[mark:])
+
+    # the first character written after mark, or '' if there is none
+    def first(self, mark):
+        for i in range(mark, len(self.parts)):
+            if self.parts[i]:
+                return self.parts[i][0]
+        return ''
+
+    # the nth character from the end, or '' if there are fewer than n
+    def last(self, n=1):
+        parts = self.parts
+        if parts and n <= len(parts[-1]):
+            return parts[-1][-n]
+        for part in reversed(parts):
+            if n <= len(part):
+                return part[-n]
+            n -= len(part)
+        return ''
+
+    def trim(self, n):
+        parts = self.parts
+        while n and parts:
+            if n < len(parts[-1]):
+                parts[-1] = parts[-1][:-n]
+                return
+            n -= len(parts.pop())
+
+    # drops the last character written before mark, leaving the marks of
+    # everything after it valid
+    def trim_before(self, mark):
+        for i in range(mark - 1, -1, -1):
+            if self.parts[i]:
+                self.parts[i] = self.parts[i][:-1]
+                return
+
+    def getvalue(self):
+        return ''.join(self.parts)
 
 
 class Comment:
+    __slots__ = ['val']
+
     def __init__(self, string):
         if string and string[0] == '#':
             string = string[1:]
@@ -177,14 +646,32 @@ class Comment:
         return ('# ' if self.val and self.val[0] != '#' else '#') + self.val
 
 
+# nodes use __slots__ because whole-mod trees hold millions of them. the
+# _dictionary and _index slots stay unset until a lookup builds them, so
+# they're also left out of pickles.
 class Stringifiable:
-    pass
+    __slots__ = []
+
+    # write_str writes the node on lines of its own and returns how many
+    # newlines it wrote. write_inline writes it from column col of a line
+    # already begun and returns how many newlines it wrote and the column it
+    # ended on.
+    def str(self, parser, indent=0):
+        out = TextWriter()
+        self.write_str(parser, out, indent)
+        return out.getvalue()
+
+    def inline_str(self, parser, indent=0, col=0):
+        out = TextWriter()
+        nl_col = self.write_inline(parser, out, indent, col)
+        return out.getvalue(), nl_col
 
 
 class TopLevel(Stringifiable):
+    __slots__ = ['contents', 'post_comments', '_dictionary', '_index',
+                 'version', 'node_count']
 
     def __init__(self, contents=None, post_comments=None):
-        super().__init__()
         if contents is None:
             self.contents = []
         else:
@@ -193,7 +680,6 @@ class TopLevel(Stringifiable):
             self.post_comments = []
         else:
             self.post_comments = [Comment(s) for s in post_comments]
-        self._dictionary = None
 
     def __len__(self):
         return len(self.contents)
@@ -258,46 +744,156 @@ class TopLevel(Stringifiable):
 
     @property
     def dictionary(self):
-        if self._dictionary is None:
+        try:
+            return self._dictionary
+        except AttributeError:
             self._dictionary = {k.val: v for k, v in reversed(self.contents)}
-        return self._dictionary
+            return self._dictionary
 
-    def str(self, parser, indent=0):
-        s = ''
+    # the pairs anywhere below here with key key, in file order
+    def find_all(self, key):
+        return self.key_index.find_all(key)
+
+    # the pairs below here at the end of path, such as '*/*/capital', where *
+    # matches any key. see KeyIndex.select.
+    def select(self, path):
+        return self.key_index.select(path)
+
+    # like dictionary, built on first use and not updated if the tree changes
+    @property
+    def key_index(self):
+        try:
+            return self._index
+        except AttributeError:
+            with gc_paused():
+                self._index = KeyIndex(self.contents)
+            return self._index
+
+    def write_str(self, parser, out, indent=0):
+        nl = 0
         for i, item in enumerate(self):
-            s += item.str(parser, indent)
+            nl += item.write_str(parser, out, indent)
             if indent <= parser.newlines_to_depth:
                 if (i < len(self) - 1 and (isinstance(item.value, Obj) or
                     isinstance(self.contents[i + 1].value, Obj))):
-                    s += '\n'
+                    out.write('\n')
+                    nl += 1
         if self.post_comments:
-            s += comments_to_str(parser, self.post_comments, indent)
-        return s
+            c_s = comments_to_str(parser, self.post_comments, indent)
+            out.write(c_s)
+            nl += c_s.count('\n')
+        return nl
+
+
+# a TopLevel that holds only where each of its pairs lies in the text until
+# that pair is asked for. looking up a key parses only the pair for it, while
+# anything that needs the whole list, such as contents or str, parses the
+# rest, raising NoParseError then if a pair turns out to be malformed. made by
+# SimpleParser.parse_lazy.
+class LazyTopLevel(TopLevel):
+    __slots__ = ['parser', 'text', 'spans', 'pairs', 'key_rows']
+
+    def __init__(self, parser, text, spans):
+        self.parser = parser
+        self.text = text
+        self.spans = spans
+        self.pairs = [None] * len(spans)
+        self.post_comments = []
+        # the first pair with a key wins, as in dictionary
+        self.key_rows = {}
+        for i, (key, _, _) in enumerate(spans):
+            self.key_rows.setdefault(key, i)
+
+    def pair(self, i):
+        pair = self.pairs[i]
+        if pair is None:
+            _, start, end = self.spans[i]
+            tree = self.parser.parse(self.text[start:end])
+            pair = self.pairs[i] = tree.contents[0]
+        return pair
+
+    # once everything is parsed, it's an ordinary TopLevel that callers may
+    # modify, so the spans and key index are dropped
+    @property
+    def contents(self):
+        if self.spans is not None:
+            for i in range(len(self.pairs)):
+                self.pair(i)
+            self.text = self.spans = self.key_rows = None
+        return self.pairs
+
+    @contents.setter
+    def contents(self, value):
+        self.pairs = value
+        self.text = self.spans = self.key_rows = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __iter__(self):
+        if self.spans is None:
+            return iter(self.pairs)
+        return (self.pair(i) for i in range(len(self.pairs)))
+
+    def __getitem__(self, key):
+        if self.spans is None:
+            return super().__getitem__(key)
+        return self.pair(self.key_rows[key]).value
+
+    def get(self, key, default=None):
+        if self.spans is None:
+            return super().get(key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_pair(self, key_val, val_val):
+        if self.spans is None:
+            return super().has_pair(key_val, val_val)
+        return key_val in self.key_rows and self[key_val].val == val_val
+
+    @property
+    def has_pairs(self):
+        if self.spans is None:
+            return TopLevel.has_pairs.fget(self)
+        return True
 
 
 class Commented(Stringifiable):
+    __slots__ = ['val', '_pre_comments', 'post_comment']
 
     def __init__(self, *args):
-        super().__init__()
         if len(args) == 3:
-            self.pre_comments = [Comment(s) for s in args[0]]
+            self._pre_comments = [Comment(s) for s in args[0]] or None
             self.val = self.str_to_val(args[1])
             self.post_comment = Comment(args[2]) if args[2] else None
         elif len(args) == 2:
-            self.pre_comments = args[1].pre_comments
+            self._pre_comments = args[1].pre_comments
             if isinstance(args[0], str):
                 self.val = self.str_to_val(args[0])
             else:
                 self.val = args[0]
             self.post_comment = args[1].post_comment
         else:
-            self.pre_comments = []
+            self._pre_comments = None
             self.val = self.str_to_val(args[0])
             self.post_comment = None
 
+    # the list is only created when something asks for it
+    @property
+    def pre_comments(self):
+        if self._pre_comments is None:
+            self._pre_comments = []
+        return self._pre_comments
+
+    @pre_comments.setter
+    def pre_comments(self, value):
+        self._pre_comments = value
+
     @property
     def has_comments(self):
-        return self.pre_comments or self.post_comment
+        return self._pre_comments or self.post_comment
 
     def str_to_val(self, string):
         return string
@@ -309,50 +905,55 @@ class Commented(Stringifiable):
         s = self.val_str()
         return s, col + chars(s, parser)
 
-    def str(self, parser, indent=0):
-        s = ''
+    def write_str(self, parser, out, indent=0):
+        nl = 1
         indent_str = '\t' if parser.tab_indents else ' ' * parser.indent_width
-        if self.pre_comments:
-            s += indent * indent_str
-            s += comments_to_str(parser, self.pre_comments, indent)
-        s += indent * indent_str + self.val_str()
+        if self._pre_comments:
+            c_s = comments_to_str(parser, self._pre_comments, indent)
+            out.write(indent * indent_str + c_s)
+            nl += c_s.count('\n')
+        out.write(indent * indent_str + self.val_str())
         if self.post_comment:
-            s += ' ' + str(self.post_comment)
-        s += '\n'
-        return s
-
-    def inline_str(self, parser, indent=0, col=0):
+            out.write(' ' + str(self.post_comment))
+        out.write('\n')
+        return nl
+
+    def write_inline(self, parser, out, indent=0, col=0):
+        if not self._pre_comments and not self.post_comment:
+            val_is, col = self.val_inline_str(parser, col)
+            out.write(val_is)
+            return 0, col
         nl = 0
         indent_str = '\t' if parser.tab_indents else ' ' * parser.indent_width
         sep = '\n' + indent * indent_str
-        s = ''
-        if self.pre_comments:
+        if self._pre_comments:
             if col > indent * parser.indent_width:
-                s += sep
+                out.write(sep)
                 nl += 1
             if isinstance(self, Op) and self.val == '}':
                 pre_indent = indent + 1
-                s += indent_str
+                out.write(indent_str)
             else:
                 pre_indent = indent
             # I can't tell the difference if I'm just after, say, "NOT = { "
             # with indent_width == 8, but whatever. # ?????
-            c_s = (comments_to_str(parser, self.pre_comments, pre_indent) +
+            c_s = (comments_to_str(parser, self._pre_comments, pre_indent) +
                    sep[1:])
-            s += c_s
+            out.write(c_s)
             nl += c_s.count('\n')
             col = indent * parser.indent_width
         val_is, col_val = self.val_inline_str(parser, col)
-        s += val_is
+        out.write(val_is)
         col = col_val
         if self.post_comment:
-            s += ' ' + str(self.post_comment) + sep
+            out.write(' ' + str(self.post_comment) + sep)
             nl += 1
             col = indent * parser.indent_width
-        return s, (nl, col)
+        return nl, col
 
 
 class String(Commented):
+    __slots__ = ['force_quote']
 
     def __init__(self, *args):
         super().__init__(*args)
@@ -366,31 +967,30 @@ class String(Commented):
 
 
 class Number(Commented):
+    __slots__ = []
 
     def str_to_val(self, string):
-        try:
-            return int(string)
-        except ValueError:
-            return float(string)
+        return str_to_number(string)
 
 
 class Date(Commented):
+    __slots__ = []
 
     def str_to_val(self, string):
-        return tuple((int(x) if x else 0) for x in string.split('.'))
+        return str_to_date(string)
 
     def val_str(self):
         return '{}.{}.{}'.format(*self.val)
 
 
 class Op(Commented):
-    pass
+    __slots__ = []
 
 
 class Pair(Stringifiable):
+    __slots__ = ['key', 'op', 'value']
 
     def __init__(self, *args):
-        super().__init__()
         if len(args) == 3:
             self.key = args[0]
             self.op = args[1]
@@ -439,65 +1039,61 @@ class Pair(Stringifiable):
     def has_comments(self):
         return any(x.has_comments for x in (self.key, self.op, self.value))
 
-    def str(self, parser, indent=0):
+    def write_str(self, parser, out, indent=0):
         indent_str = '\t' if parser.tab_indents else ' ' * parser.indent_width
-        s = indent * indent_str
-        self_is, _ = self.inline_str(parser, indent,
-                                     indent * parser.indent_width)
-        if self_is[-1].isspace():
+        out.write(indent * indent_str)
+        nl, _ = self.write_inline(parser, out, indent,
+                                  indent * parser.indent_width)
+        if out.last().isspace():
             if indent:
-                s += self_is[:-len(s)]
-            else:
-                s += self_is
+                out.trim(indent * len(indent_str))
         else:
-            s += self_is + '\n'
-        return s
+            out.write('\n')
+            nl += 1
+        return nl
 
-    def inline_str(self, parser, indent=0, col=0):
-        if isinstance(self.key, String) and self.key.val in parser.fq_keys:
+    def write_inline(self, parser, out, indent=0, col=0):
+        if (isinstance(self.key, String) and self.key.val in parser.fq_keys and
+            isinstance(self.value, String)):
             self.value.force_quote = True
-        s = ''
-        nl = 0
-        key_is, (nl_key, col_key) = self.key.inline_str(parser, indent, col)
-        s += key_is
-        nl += nl_key
-        col = col_key
-        if not s[-1].isspace():
-            s += ' '
+        nl, col = self.key.write_inline(parser, out, indent, col)
+        if not out.last().isspace():
+            out.write(' ')
             col += 1
-        op_is, (nl_op, col_op) = self.op.inline_str(parser, indent, col)
+        mark = out.mark()
+        nl_op, col_op = self.op.write_inline(parser, out, indent, col)
         if (col > indent * parser.indent_width and
             col_op > parser.chars_per_line):
-            if not s[-2].isspace():
-                s = s[:-1]
-            op_s = self.op.str(parser, indent)
-            s += '\n' + op_s
-            nl += 1 + op_s.count('\n')
+            out.rollback(mark)
+            if not out.last(2).isspace():
+                out.trim(1)
+            out.write('\n')
+            nl += 1 + self.op.write_str(parser, out, indent)
             col = indent * parser.indent_width
         else:
-            if op_is[0] == '\n':
-                s = s[:-1]
+            # the op can only start on a new line if it wrote one
+            if nl_op and out.first(mark) == '\n':
+                out.trim_before(mark)
                 col -= 1
-            s += op_is
             nl += nl_op
             col = col_op
-        if not s[-1].isspace():
-            s += ' '
+        if not out.last().isspace():
+            out.write(' ')
             col += 1
-        val_is, (nl_val, col_val) = self.value.inline_str(parser, indent, col)
-        if val_is[0] == '\n':
-            s = s[:-1]
+        mark = out.mark()
+        nl_val, col_val = self.value.write_inline(parser, out, indent, col)
+        if nl_val and out.first(mark) == '\n':
+            out.trim_before(mark)
             col -= 1
-        s += val_is
         nl += nl_val
         col = col_val
-        return s, (nl, col)
+        return nl, col
 
 
 class Obj(Stringifiable):
+    __slots__ = ['kel', 'contents', 'ker', '_dictionary', '_index']
 
     def __init__(self, kel, contents=None, ker=None):
-        super().__init__()
         if contents is None:
             self.kel = Op('{')
             self.contents = kel
@@ -506,7 +1102,6 @@ class Obj(Stringifiable):
             self.kel = kel
             self.contents = contents
             self.ker = ker if ker is not None else Op('}')
-        self._dictionary = None
 
     def __len__(self):
         return len(self.contents)
@@ -557,26 +1152,46 @@ class Obj(Stringifiable):
 
     @property
     def dictionary(self):
-        if self._dictionary is None:
+        try:
+            return self._dictionary
+        except AttributeError:
             self._dictionary = {k.val: v for k, v in reversed(self.contents)}
-        return self._dictionary
+            return self._dictionary
 
-    def str(self, parser, indent=0):
+    # the pairs anywhere below here with key key, in file order
+    def find_all(self, key):
+        return self.key_index.find_all(key)
+
+    # the pairs below here at the end of path, such as '*/*/capital', where *
+    # matches any key. see KeyIndex.select.
+    def select(self, path):
+        return self.key_index.select(path)
+
+    # like dictionary, built on first use and not updated if the tree changes
+    @property
+    def key_index(self):
+        try:
+            return self._index
+        except AttributeError:
+            with gc_paused():
+                self._index = KeyIndex(self.contents)
+            return self._index
+
+    def write_str(self, parser, out, indent=0):
         indent_str = '\t' if parser.tab_indents else ' ' * parser.indent_width
-        s = indent * indent_str
-        self_is, _ = self.inline_str(parser, indent,
-                                     indent * parser.indent_width)
-        if self_is[-1].isspace():
+        out.write(indent * indent_str)
+        nl, _ = self.write_inline(parser, out, indent,
+                                  indent * parser.indent_width)
+        if out.last().isspace():
             if indent:
-                s += self_is[:-len(s)]
-            else:
-                s += self_is
+                out.trim(indent * len(indent_str))
         else:
-            s += self_is + '\n'
-        return s
+            out.write('\n')
+            nl += 1
+        return nl
 
     def might_fit_on_line(self, parser, indent):
-        if self.kel.has_comments or self.ker.pre_comments:
+        if self.kel.has_comments or self.ker._pre_comments:
             return False
         if self.contents and isinstance(self.contents[0], Pair):
             return (len(self) == 1 and not self.contents[0].has_comments and
@@ -585,88 +1200,510 @@ class Obj(Stringifiable):
         return all(isinstance(x, Commented) and not x.has_comments
                    for x in self)
 
-    def inline_str(self, parser, indent=0, col=0):
-        s = ''
-        nl = 0
-        kel_is, (nl_kel, col_kel) = self.kel.inline_str(parser, indent, col)
-        s += kel_is
-        nl += nl_kel
-        col = col_kel
-        if self.might_fit_on_line(parser, indent):
-            # attempt one line object
-            s_oneline, col_oneline = s, col
+    # tries to fit the object on the rest of the line, returning (nl, col)
+    # if it does. the attempt stops at the first line break any item writes.
+    def write_oneline(self, parser, out, indent, col):
+        mark = out.mark()
+        outer_oneline = out.oneline
+        out.oneline = True
+        try:
             for item in self:
-                item_is, (nl_item, col_item) = item.inline_str(parser, indent,
-                                                               1 + col_oneline)
-                s_oneline += ' ' + item_is
-                col_oneline = col_item
-                if nl_item > 0 or col_oneline + 2 > parser.chars_per_line:
+                out.write(' ')
+                _, col = item.write_inline(parser, out, indent, 1 + col)
+                if col + 2 > parser.chars_per_line:
                     break
             else:
+                out.oneline = outer_oneline
                 if self.contents:
-                    s_oneline += ' '
-                    col_oneline += 1
-                ker_is, (nl_ker, col_ker) = self.ker.inline_str(parser, indent,
-                                                                col_oneline)
-                if nl_ker == 0 or (chars(ker_is.splitlines()[0], parser) <=
-                                   parser.chars_per_line):
-                    s_oneline += ker_is
-                    return s_oneline, (nl_ker, col_ker)
+                    out.write(' ')
+                    col += 1
+                ker_mark = out.mark()
+                nl_ker, col_ker = self.ker.write_inline(parser, out, indent,
+                                                        col)
+                if nl_ker == 0 or (chars(out.since(ker_mark).splitlines()[0],
+                                         parser) <= parser.chars_per_line):
+                    return nl_ker, col_ker
+        except LineBroken:
+            pass
+        finally:
+            out.oneline = outer_oneline
+        out.rollback(mark)
+        return None
+
+    def write_inline(self, parser, out, indent=0, col=0):
+        nl, col = self.kel.write_inline(parser, out, indent, col)
+        if self.might_fit_on_line(parser, indent):
+            nl_col = self.write_oneline(parser, out, indent, col)
+            if nl_col is not None:
+                return nl_col
         indent_str = '\t' if parser.tab_indents else ' ' * parser.indent_width
         if self.has_pairs:
-            if s[-1].isspace():
+            if out.last().isspace():
                 if indent:
-                    s = s[:-indent * len(indent_str)]
+                    out.trim(indent * len(indent_str))
             else:
-                s += '\n'
+                out.write('\n')
                 nl += 1
             for i, item in enumerate(self):
-                item_s = item.str(parser, indent + 1)
-                s += item_s
-                nl += item_s.count('\n')
+                nl += item.write_str(parser, out, indent + 1)
                 if indent + 1 <= parser.newlines_to_depth:
                     if (i < len(self) - 1 and (isinstance(item.value, Obj) or
                         isinstance(self.contents[i + 1].value, Obj))):
-                        s += '\n'
+                        out.write('\n')
                         nl += 1
-            s += indent * indent_str
+            out.write(indent * indent_str)
             col = indent * parser.indent_width
         else:
             sep = '\n' + (indent + 1) * indent_str
             sep_col = chars(sep, parser)
-            if s[-1].isspace():
-                s += indent_str
+            if out.last().isspace():
+                out.write(indent_str)
             else:
-                s += sep
+                out.write(sep)
                 nl += 1
             col = sep_col
             for item in self:
-                if not s[-1].isspace():
-                    s += ' '
+                if not out.last().isspace():
+                    out.write(' ')
                     col += 1
-                item_is, (nl_item, col_item) = item.inline_str(parser,
-                                                               indent + 1, col)
+                mark = out.mark()
+                nl_item, col_item = item.write_inline(parser, out, indent + 1,
+                                                      col)
                 if (col > (indent + 1) * parser.indent_width and
                     col_item > parser.chars_per_line):
-                    if not s[-2].isspace():
-                        s = s[:-1]
-                    s += sep
+                    out.rollback(mark)
+                    if not out.last(2).isspace():
+                        out.trim(1)
+                    out.write(sep)
                     nl += 1
                     col = sep_col
-                    item_is, (nl_item, col_item) = item.inline_str(parser,
-                        indent + 1, col)
-                s += item_is
+                    nl_item, col_item = item.write_inline(parser, out,
+                                                          indent + 1, col)
                 nl += nl_item
                 col = col_item
-            if not s[-1].isspace():
-                s += '\n' + indent * indent_str
+            if not out.last().isspace():
+                out.write('\n' + indent * indent_str)
                 nl += 1
                 col = indent * parser.indent_width
-        ker_is, (nl_ker, col_ker) = self.ker.inline_str(parser, indent, col)
-        s += ker_is
+        nl_ker, col_ker = self.ker.write_inline(parser, out, indent, col)
         nl += nl_ker
-        col = col_ker
-        return s, (nl, col)
+        return nl, col_ker
+
+
+# every pair under a TopLevel or Obj, in file order, with the position of
+# its parent pair and its depth, plus the positions of the pairs with each
+# key. one walk of the tree builds it, and queries then only look at pairs
+# with the key they end in. bare values and objects are passed over.
+class KeyIndex:
+    def __init__(self, contents):
+        self.pairs = []
+        self.parent = array.array('i')
+        self.depth = array.array('i')
+        self.by_key = {}
+        stack = [(item, -1, 0) for item in reversed(contents)]
+        while stack:
+            item, parent, depth = stack.pop()
+            if not isinstance(item, Pair):
+                continue
+            i = len(self.pairs)
+            self.pairs.append(item)
+            self.parent.append(parent)
+            self.depth.append(depth)
+            self.by_key.setdefault(item.key.val, []).append(i)
+            if isinstance(item.value, Obj):
+                stack.extend((x, i, depth + 1)
+                             for x in reversed(item.value.contents))
+
+    def find_all(self, key):
+        return [self.pairs[i] for i in self.by_key.get(key, ())]
+
+    # path is a list of key values, or a string of keys separated by /, which
+    # are read as dates or numbers where they look like them. * matches any
+    # key. a match is a pair as deep as path is long, whose key and whose
+    # parents' keys match path's.
+    def select(self, path):
+        if isinstance(path, str):
+            path = [str_to_key(s) for s in path.split('/')]
+        last = len(path) - 1
+        if path[last] == '*':
+            candidates = range(len(self.pairs))
+        else:
+            candidates = self.by_key.get(path[last], ())
+        matches = []
+        for i in candidates:
+            if self.depth[i] != last:
+                continue
+            j = self.parent[i]
+            for key in reversed(path[:last]):
+                if key != '*' and self.pairs[j].key.val != key:
+                    break
+                j = self.parent[j]
+            else:
+                matches.append(self.pairs[i])
+        return matches
+
+
+# a whole file as parallel arrays with one row per pair or bare value, in
+# file order. key and value hold ids into values, the file's distinct keys
+# and scalar values (-1 for a bare value's key and for an object's value),
+# and end holds the row after a row's subtree, so an object's children start
+# on the next row and each child's end is its next sibling. only the arrays
+# and the distinct values are Python objects; the views below are made on
+# demand and give the read-only part of the TopLevel/Obj/Pair interface.
+class ColumnarTree:
+    __slots__ = ['kind', 'parent', 'key', 'value', 'end', 'values', 'version',
+                 'node_count', '_dictionaries']
+    SCALAR, OBJ = 0, 1
+
+    def __init__(self):
+        self.kind = array.array('b')
+        self.parent = array.array('i')
+        self.key = array.array('i')
+        self.value = array.array('i')
+        self.end = array.array('i')
+        self.values = []
+
+    @property
+    def root(self):
+        return ColumnarObj(self, -1)
+
+    def item(self, row):
+        if self.kind[row] == self.OBJ:
+            value = ColumnarObj(self, row)
+        else:
+            value = ColumnarValue(self.values[self.value[row]])
+        if self.key[row] < 0:
+            return value
+        return ColumnarPair(ColumnarValue(self.values[self.key[row]]), value)
+
+    def __len__(self):
+        return len(self.root)
+
+    def __iter__(self):
+        return iter(self.root)
+
+    def __getitem__(self, key):
+        return self.root[key]
+
+    @property
+    def contents(self):
+        return self.root.contents
+
+    @property
+    def dictionary(self):
+        return self.root.dictionary
+
+    def get(self, *args, **kwargs):
+        return self.root.get(*args, **kwargs)
+
+    def has_pair(self, key_val, val_val):
+        return self.root.has_pair(key_val, val_val)
+
+    @property
+    def has_pairs(self):
+        return self.root.has_pairs
+
+
+class ColumnarValue:
+    __slots__ = ['val']
+
+    def __init__(self, val):
+        self.val = val
+
+
+class ColumnarPair:
+    __slots__ = ['key', 'value']
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def __iter__(self):
+        yield self.key
+        yield self.value
+
+
+class ColumnarObj:
+    __slots__ = ['tree', 'row']
+
+    def __init__(self, tree, row):
+        self.tree = tree
+        self.row = row
+
+    def rows(self):
+        end = self.tree.end
+        row = self.row + 1
+        stop = len(end) if self.row < 0 else end[self.row]
+        while row < stop:
+            yield row
+            row = end[row]
+
+    def __len__(self):
+        return sum(1 for _ in self.rows())
+
+    def __iter__(self):
+        return map(self.tree.item, self.rows())
+
+    def __getitem__(self, key):
+        return self.dictionary[key]
+
+    @property
+    def contents(self):
+        return list(self)
+
+    @property
+    def dictionary(self):
+        try:
+            dictionaries = self.tree._dictionaries
+        except AttributeError:
+            dictionaries = self.tree._dictionaries = {}
+        try:
+            return dictionaries[self.row]
+        except KeyError:
+            tree = self.tree
+            values = tree.values
+            items = [(values[tree.key[row]], tree.item(row).value)
+                     for row in self.rows() if tree.key[row] >= 0]
+            dictionaries[self.row] = dict(reversed(items))
+            return dictionaries[self.row]
+
+    def get(self, *args, **kwargs):
+        return self.dictionary.get(*args, **kwargs)
+
+    # assumes keys occur at most once
+    def has_pair(self, key_val, val_val):
+        return key_val in self.dictionary and self[key_val].val == val_val
+
+    @property
+    def has_pairs(self):
+        for row in self.rows():
+            return self.tree.key[row] >= 0
+        return True
+
+
+# binary cache format for parse trees: a header, an array of unsigned ints,
+# and the text of every string the tree holds. the array starts with the
+# lengths of the interned strings (keys, values, ops and float reprs) and then
+# of the comments, then lists the nodes in post-order, each a tag plus its
+# fields, so a decoder just keeps a stack of finished nodes. the ints are
+# little-endian and all the same width, the narrowest that holds the largest,
+# so the array loads in one call.
+TREE_MAGIC = b'CK2T'
+# magic, version, int typecode, int count and text size
+TREE_HEADER = struct.Struct('<4sIcII')
+TREE_INT_TYPES = [(b'B', 1 << 8), (b'H', 1 << 16), (b'I', 1 << 32),
+                  (b'Q', 1 << 64)]
+(TAG_STRING, TAG_QUOTED, TAG_INT, TAG_FLOAT, TAG_DATE, TAG_OP, TAG_PAIR,
+ TAG_OBJ, TAG_TOPLEVEL) = range(9)
+TAG_COMMENTED = 16 # leaf tags with comments: npre, pre ids, post id + 1
+
+def zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+def tree_to_bytes(tree):
+    strings = {}
+    comments = {}
+    string_id = lambda s: strings.setdefault(s, len(strings))
+    comment_id = lambda c: comments.setdefault(c.val, len(comments))
+    # nodes in reverse post-order: pop a node, record it, then push its
+    # children left to right so the rightmost is recorded next
+    records = [[TAG_TOPLEVEL, len(tree.contents), 0,
+                len(tree.post_comments)] +
+               [comment_id(c) for c in tree.post_comments]]
+    stack = list(tree.contents)
+    while stack:
+        node = stack.pop()
+        cls = node.__class__
+        if cls is Pair:
+            records.append([TAG_PAIR])
+            stack += node.key, node.op, node.value
+            continue
+        if cls is Obj:
+            records.append([TAG_OBJ, len(node.contents)])
+            stack.append(node.kel)
+            stack += node.contents
+            stack.append(node.ker)
+            continue
+        val = node.val
+        if cls is String:
+            record = [TAG_QUOTED if node.force_quote else TAG_STRING,
+                      string_id(val)]
+        elif cls is Op:
+            record = [TAG_OP, string_id(val)]
+        elif cls is Number and val.__class__ is int:
+            record = [TAG_INT, zigzag(val)]
+        elif cls is Number and val.__class__ is float:
+            record = [TAG_FLOAT, string_id(repr(val))]
+        elif cls is Date:
+            record = [TAG_DATE, len(val)] + [zigzag(x) for x in val]
+        else:
+            raise TypeError('cannot serialize {!r}'.format(node))
+        if node._pre_comments or node.post_comment:
+            record[0] |= TAG_COMMENTED
+            pre_comments = node._pre_comments or []
+            record.append(len(pre_comments))
+            record += [comment_id(c) for c in pre_comments]
+            record.append(comment_id(node.post_comment) + 1
+                          if node.post_comment else 0)
+        records.append(record)
+    records[0][2] = len(records) - 1 # node count
+    ints = [len(strings)] + [len(s) for s in strings]
+    ints.append(len(comments))
+    ints += [len(s) for s in comments]
+    for record in reversed(records):
+        ints += record
+    largest = max(ints)
+    for typecode, limit in TREE_INT_TYPES:
+        if largest < limit:
+            break
+    else:
+        raise TypeError('cannot serialize {}'.format(largest))
+    stream = array.array(typecode.decode(), ints)
+    if sys.byteorder == 'big':
+        stream.byteswap()
+    text = (''.join(strings) + ''.join(comments)).encode('utf-8',
+                                                         'surrogatepass')
+    return (TREE_HEADER.pack(TREE_MAGIC, VERSION, typecode, len(ints),
+                             len(text)) + stream.tobytes() + text)
+
+# returns None for data from another format or version
+def tree_from_bytes(data, intern_pool):
+    if len(data) < TREE_HEADER.size:
+        return None
+    magic, version, typecode, count, text_size = TREE_HEADER.unpack_from(
+        data)
+    if magic != TREE_MAGIC or version != VERSION:
+        return None
+    start = TREE_HEADER.size
+    ints = array.array(typecode.decode())
+    stream_size = count * ints.itemsize
+    ints.frombytes(memoryview(data)[start:start + stream_size])
+    if sys.byteorder == 'big':
+        ints.byteswap()
+    ints = ints.tolist()
+    start += stream_size
+    text = data[start:start + text_size].decode('utf-8', 'surrogatepass')
+    intern = intern_pool.setdefault
+    pos = 0
+    i = 1
+    strings = []
+    for length in ints[i:i + ints[0]]:
+        s = text[pos:pos + length]
+        strings.append(intern(s, s))
+        pos += length
+    i += ints[0]
+    comments = []
+    for length in ints[i + 1:i + 1 + ints[i]]:
+        comments.append(text[pos:pos + length])
+        pos += length
+    i += 1 + ints[i]
+    new = object.__new__
+    def comment(k):
+        c = new(Comment)
+        c.val = comments[k]
+        return c
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    n = len(ints)
+    while i < n:
+        tag = ints[i]
+        # uncommented strings, ops and ints are most of any tree
+        if tag == TAG_STRING:
+            node = new(String)
+            node.val = strings[ints[i + 1]]
+            node.force_quote = False
+            node._pre_comments = node.post_comment = None
+            push(node)
+            i += 2
+        elif tag == TAG_OP:
+            node = new(Op)
+            node.val = strings[ints[i + 1]]
+            node._pre_comments = node.post_comment = None
+            push(node)
+            i += 2
+        elif tag == TAG_INT:
+            node = new(Number)
+            val = ints[i + 1]
+            node.val = -((val + 1) >> 1) if val & 1 else val >> 1
+            node._pre_comments = node.post_comment = None
+            push(node)
+            i += 2
+        elif tag == TAG_PAIR:
+            node = new(Pair)
+            node.value = pop()
+            node.op = pop()
+            node.key = pop()
+            push(node)
+            i += 1
+        elif tag == TAG_OBJ:
+            count = ints[i + 1]
+            node = new(Obj)
+            node.kel = stack[-count - 2]
+            node.contents = stack[-count - 1:-1]
+            node.ker = stack[-1]
+            del stack[-count - 2:]
+            push(node)
+            i += 2
+        elif tag == TAG_TOPLEVEL:
+            count, node_count, npost = ints[i + 1:i + 4]
+            i += 4
+            tree = new(TopLevel)
+            tree.contents = stack[len(stack) - count:]
+            tree.post_comments = [comment(k) for k in ints[i:i + npost]]
+            tree.version = version
+            tree.node_count = node_count
+            return tree
+        else:
+            kind = tag & ~TAG_COMMENTED
+            if kind == TAG_STRING or kind == TAG_QUOTED:
+                node = new(String)
+                node.val = strings[ints[i + 1]]
+                node.force_quote = kind == TAG_QUOTED
+                i += 2
+            elif kind == TAG_OP:
+                node = new(Op)
+                node.val = strings[ints[i + 1]]
+                i += 2
+            elif kind == TAG_INT:
+                node = new(Number)
+                node.val = unzigzag(ints[i + 1])
+                i += 2
+            elif kind == TAG_FLOAT:
+                node = new(Number)
+                node.val = float(strings[ints[i + 1]])
+                i += 2
+            else:
+                count = ints[i + 1]
+                node = new(Date)
+                node.val = tuple(unzigzag(x)
+                                 for x in ints[i + 2:i + 2 + count])
+                i += 2 + count
+            if tag & TAG_COMMENTED:
+                npre = ints[i]
+                node._pre_comments = [comment(k)
+                                      for k in ints[i + 1:i + 1 + npre]]
+                post = ints[i + 1 + npre]
+                node.post_comment = comment(post - 1) if post else None
+                i += 2 + npre
+            else:
+                node._pre_comments = node.post_comment = None
+            push(node)
+    return None
+
+
+def lexer_error(string, pos):
+    line = string.count('\n', 0, pos) + 1
+    col = pos - string.rfind('\n', 0, pos)
+    return LexerError((line, col), string.splitlines()[line - 1])
+
+# bytes as a file opened in text mode would read them
+def decode_text(data, encoding):
+    text = bytes(data).decode(encoding, 'replace')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
 
 
 class SimpleTokenizer:
@@ -680,9 +1717,112 @@ class SimpleTokenizer:
     ]
     useless = ['Comment', 'Space']
     t = staticmethod(make_tokenizer(specs))
+    # one match per token, which skips space and comments and classifies the
+    # token as it goes, yielding (type, value) tuples. a Key is split into
+    # Date/Number/Name by requiring those alternatives to run to the end of
+    # the key, which is the same as fullmatching the Key text.
+    key_end = r'(?![^\s"#<=>{}])'
+    scanner = re.compile(
+        r'(?:\s+|#.*)*(?:'
+        r'(?P<Brace>[{}])|'
+        r'(?P<Op>[<=>]=?)|'
+        r'(?P<String>".*?")|'
+        r'(?P<Date>-?\d*\.\d*\.\d*' + key_end + ')|'
+        r'(?P<Number>-?\d+(?:\.\d+)?' + key_end + ')|'
+        r'(?P<Name>[^\s"#<=>{}]+)|'
+        r'(?P<Error>")|\Z)')
 
     @classmethod
     def tokenize(cls, string):
+        for m in cls.scanner.finditer(string):
+            type = m.lastgroup
+            if type is None:
+                return
+            if type == 'Error':
+                raise lexer_error(string, m.start(type))
+            yield type, m.group(type)
+
+    # the scanner over undecoded bytes, for the encodings in byte_encodings.
+    # space is every byte that decodes to a character \s matches, and a line
+    # ends at \r as well as \n, since text mode reads a lone \r as a newline.
+    byte_encodings = {'cp1252'}
+    byte_space = rb'\t\n\x0b\x0c\r\x1c-\x1f \xa0'
+    byte_key_end = rb'(?![^' + byte_space + rb'"#<=>{}])'
+    byte_scanner = re.compile(
+        rb'(?:[' + byte_space + rb']+|#[^\r\n]*)*(?:'
+        rb'(?P<Brace>[{}])|'
+        rb'(?P<Op>[<=>]=?)|'
+        rb'(?P<String>"[^\r\n]*?")|'
+        rb'(?P<Date>-?[0-9]*\.[0-9]*\.[0-9]*' + byte_key_end + rb')|'
+        rb'(?P<Number>-?[0-9]+(?:\.[0-9]+)?' + byte_key_end + rb')|'
+        rb'(?P<Name>[^' + byte_space + rb'"#<=>{}]+)|'
+        rb'(?P<Error>")|\Z)')
+
+    # whether tokenize_bytes can stand in for decoding the whole file. with
+    # errors other than 'replace', decoding token by token could drop or
+    # reject different bytes than decoding the file would.
+    @classmethod
+    def reads_bytes(cls, encoding, errors):
+        return (cls.byte_scanner is not None and errors == 'replace' and
+                codecs.lookup(encoding).name in cls.byte_encodings)
+
+    # the same tokens as tokenize(data decoded as text mode would), decoding
+    # only the bytes of each token. most tokens repeat, so each distinct one
+    # is decoded once.
+    @classmethod
+    def tokenize_bytes(cls, data, encoding):
+        decoded = {}
+        for m in cls.byte_scanner.finditer(data):
+            type = m.lastgroup
+            if type is None:
+                return
+            if type == 'Error':
+                pos = m.start(type)
+                raise lexer_error(decode_text(data, encoding),
+                                  len(decode_text(data[:pos], encoding)))
+            value = m.group(type)
+            string = decoded.get(value)
+            if string is None:
+                string = decoded[value] = value.decode(encoding, 'replace')
+            yield type, string
+
+    # (type, start, end) of each token, as offsets into data. nothing is
+    # decoded or copied, so the bytes of a token are data[start:end].
+    @classmethod
+    def spans(cls, data, encoding):
+        for m in cls.byte_scanner.finditer(data):
+            type = m.lastgroup
+            if type is None:
+                return
+            if type == 'Error':
+                pos = m.start(type)
+                raise lexer_error(decode_text(data, encoding),
+                                  len(decode_text(data[:pos], encoding)))
+            yield (type,) + m.span(type)
+
+    # comments and strings are matched whole so braces inside them are passed
+    # over, the same as in the scanner
+    brace_scanner = re.compile(r'#.*|".*?"|[{}]')
+
+    # the end of the braced value whose { is just before pos, or None if it
+    # isn't closed
+    @classmethod
+    def block_end(cls, string, pos):
+        depth = 1
+        for m in cls.brace_scanner.finditer(string, pos):
+            c = string[m.start()]
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if not depth:
+                    return m.end()
+        return None
+
+    # the original funcparserlib lexer, kept for FullTokenizer and as the
+    # reference for the scanner above
+    @classmethod
+    def spec_tokenize(cls, string):
         for x in cls.t(string):
             if x.type not in cls.useless:
                 if x.type == 'Key':
@@ -717,19 +1857,347 @@ class FullTokenizer(SimpleTokenizer):
     ]
     useless = ['whitespace']
     t = staticmethod(make_tokenizer(specs))
+    # the specs above as one pattern, with whitespace skipped. an alternation
+    # takes the first alternative that matches, as the lexer takes the first
+    # spec, so the tokens are the same. tokenize is SimpleTokenizer's.
+    scanner = re.compile(
+        r'[ \t]*(?:'
+        r'(?P<comment>#(?:.*\S)?)|'
+        r'(?P<newline>\r?\n)|'
+        r'(?P<brace>[{}])|'
+        r'(?P<op>[<=>]=?)|'
+        r'(?P<date>-?\d*\.\d*\.\d*)|'
+        r'(?P<number>-?\d+(?:\.\d+)?(?!\w))|'
+        r'(?P<quoted_string>".*?")|'
+        r'(?P<unquoted_string>[^\s"#<=>{}]+)|'
+        r'(?P<Error>[\s\S])|\Z)')
+    # newlines and comments are tokens here, so files are read as text
+    byte_scanner = None
+
+
+# the tokens of a mapped file, as SimpleParser.token_spans yields them.
+# iterating gives (type, start, end) tuples, and text decodes a span only
+# when it's asked for. the offsets are good only while the mapping is open.
+class TokenSpans:
+    __slots__ = ['data', 'encoding']
+
+    def __init__(self, data, encoding):
+        self.data = data
+        self.encoding = encoding
+
+    def __iter__(self):
+        return SimpleTokenizer.spans(self.data, self.encoding)
+
+    # a String's text includes its quotes
+    def text(self, start, end):
+        return self.data[start:end].decode(self.encoding, 'replace')
 
 
+# parse_tree_cache. once the trees held add up to more than max_nodes nodes,
+# the least recently used are evicted. the default is a few hundred MB. a tree
+# bigger than the whole budget isn't kept, and evicts nothing.
+class TreeCache:
+    def __init__(self, max_nodes=5000000):
+        self.max_nodes = max_nodes
+        self.trees = collections.OrderedDict()
+        self.nodes = 0
+        self.peak_nodes = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.trees)
+
+    def __contains__(self, path):
+        return path in self.trees
+
+    def __getitem__(self, path):
+        tree, _ = self.trees[path]
+        self.trees.move_to_end(path)
+        self.hits += 1
+        return tree
+
+    def __setitem__(self, path, tree):
+        if path in self.trees:
+            del self[path]
+        size = getattr(tree, 'node_count', 1)
+        if self.max_nodes is not None:
+            if size > self.max_nodes:
+                return
+            while self.nodes + size > self.max_nodes:
+                _, (_, evicted) = self.trees.popitem(last=False)
+                self.nodes -= evicted
+                self.evictions += 1
+        self.trees[path] = tree, size
+        self.nodes += size
+        self.peak_nodes = max(self.peak_nodes, self.nodes)
+
+    def __delitem__(self, path):
+        _, size = self.trees.pop(path)
+        self.nodes -= size
+
+    def clear(self):
+        self.trees.clear()
+        self.nodes = 0
+
+# each parse_files worker process keeps one parser for all its files
+worker_parser = None
+
+def init_parse_worker(parser_class, strict, engine, cache_store):
+    global worker_parser
+    worker_parser = parser_class(strict=strict, engine=engine)
+    worker_parser.cache_store = cache_store
+
+# returns the tree as a disk cache entry, which the caller loads through its
+# own intern pool, or None if the tree can't be serialized
+def parse_in_worker(path, encoding, errors, cachepath):
+    tree = worker_parser.parse_path(path, encoding, errors)
+    tree.version = VERSION
+    f = io.BytesIO()
+    try:
+        worker_parser.dump_tree(tree, f)
+    except (RecursionError, TypeError):
+        return None
+    if cachepath is not None:
+        worker_parser.cache_store.write(cachepath, f.getvalue())
+    return f.getvalue()
+
+# written under a temporary name and renamed into place, so that nothing ever
+# reads a half-written file
+def write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temppath = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+    try:
+        temppath.write_bytes(data)
+        os.replace(str(temppath), str(path))
+    except OSError:
+        if temppath.exists():
+            temppath.unlink()
+        raise
+
+# content hashes of source files, kept with the size, mtime and inode they
+# were taken at, so a file is only read and hashed again once one of those
+# changes. loaded once per path and saved at exit if anything was added.
+class CacheManifest:
+    def __init__(self, path):
+        self.path = path
+        self.changed = False
+        try:
+            with path.open('rb') as f:
+                self.entries = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError):
+            self.entries = {}
+
+    def digest(self, path):
+        st = os.stat(str(path))
+        signature = st.st_size, st.st_mtime_ns, st.st_ino
+        entry = self.entries.get(str(path))
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        return self.record(path, path.read_bytes(), st)
+
+    # for a file just written with data
+    def record(self, path, data, st=None):
+        if st is None:
+            st = os.stat(str(path))
+        signature = st.st_size, st.st_mtime_ns, st.st_ino
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        self.entries[str(path)] = signature, digest
+        self.changed = True
+        return digest
+
+    def save(self):
+        if self.changed:
+            write_atomic(self.path, pickle.dumps(self.entries))
+            self.changed = False
+
+manifests = {}
+
+def get_manifest(path):
+    try:
+        return manifests[path]
+    except KeyError:
+        manifest = manifests[path] = CacheManifest(path)
+        return manifest
+
+def save_manifests():
+    for manifest in manifests.values():
+        try:
+            manifest.save()
+        except OSError:
+            print('Error saving cache manifest {}'.format(manifest.path),
+                  file=sys.stderr)
+            traceback.print_exc()
+
+atexit.register(save_manifests)
+
+# facts a script derives from single files, kept between runs. entries map
+# each path to its signature and the facts last derived from it, and are
+# saved along with the manifests.
+class FactCache(CacheManifest):
+    def __init__(self, path):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def facts(self, path, derive):
+        st = os.stat(str(path))
+        signature = st.st_size, st.st_mtime_ns, st.st_ino
+        entry = self.entries.get(str(path))
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+        facts = derive()
+        self.entries[str(path)] = signature, facts
+        self.changed = True
+        self.misses += 1
+        return facts
+
+def get_fact_cache(name):
+    path = cachedir / 'facts' / name
+    try:
+        return manifests[path]
+    except KeyError:
+        fact_cache = manifests[path] = FactCache(path)
+        return fact_cache
+
+# a cache store maps the cachepaths from get_cachepath to entries. read gets
+# an entry's bytes, or None if there is none or it is older than min_mtime.
+
+# one file per entry, at its cachepath
+class DirCacheStore:
+    def read(self, cachepath, min_mtime=None):
+        try:
+            if (min_mtime is not None and
+                    os.path.getmtime(str(cachepath)) < min_mtime):
+                return None
+            return cachepath.read_bytes()
+        except OSError:
+            return None
+
+    def write(self, cachepath, data):
+        write_atomic(cachepath, data)
+
+# one memory-mapped sqlite database per repo (or for vanilla, or for files
+# outside any repo), keyed by the rest of the cachepath, which is the file's
+# latest commit, if any, and the hash of its path and encoding. saves a warm
+# run the open, stat and read calls of a file per entry.
+class PackedCacheStore:
+    mmap_size = 1 << 30
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    # sqlite connections can't be shared between threads or processes, so
+    # each thread opens its own, and a forked child starts over
+    def __getstate__(self):
+        return {'cachedir': self.cachedir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cachedir'])
+
+    def locate(self, cachepath):
+        if self.pid != os.getpid():
+            self.__init__(self.cachedir)
+        parts = cachepath.relative_to(self.cachedir).parts
+        dbpath = self.cachedir.joinpath(*parts[:1 if len(parts) > 1 else 0],
+                                        'cache.sqlite')
+        try:
+            connections = self.local.connections
+        except AttributeError:
+            connections = self.local.connections = {}
+        try:
+            db = connections[dbpath]
+        except KeyError:
+            dbpath.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(dbpath), timeout=60)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('PRAGMA mmap_size = {}'.format(self.mmap_size))
+            db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY '
+                       'KEY, mtime REAL, data BLOB)')
+            connections[dbpath] = db
+        return db, '/'.join(parts[1:] if len(parts) > 1 else parts)
+
+    def read(self, cachepath, min_mtime=None):
+        db, key = self.locate(cachepath)
+        row = db.execute('SELECT mtime, data FROM entries WHERE key = ?',
+                         (key,)).fetchone()
+        if row is None or min_mtime is not None and row[0] < min_mtime:
+            return None
+        return row[1]
+
+    def write(self, cachepath, data):
+        db, key = self.locate(cachepath)
+        with db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                       (key, time.time(), data))
+
+# disk cache entries are written by one background thread. put blocks once
+# maxsize writes are waiting, and everything queued is written before exit.
+class CacheWriter:
+    def __init__(self, maxsize=64):
+        self.queue = queue.Queue(maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, cache_store, cachepath, data):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put((cache_store, cachepath, data))
+
+    def run(self):
+        while True:
+            cache_store, cachepath, data = self.queue.get()
+            try:
+                cache_store.write(cachepath, data)
+            except (OSError, sqlite3.Error):
+                print('Error writing cache for {}'.format(cachepath),
+                      file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+cache_writer = CacheWriter()
+atexit.register(cache_writer.flush)
+
 class SimpleParser:
     tokenizer = SimpleTokenizer
+    # the first engine is the default
+    engines = ['stack', 'funcparserlib']
     repos = {}
 
-    def __init__(self, *moddirs, strict=True):
+    def __init__(self, *moddirs, strict=True, engine=None):
         self.moddirs = list(moddirs)
         self.basedir = vanilladir
         self.strict = strict
+        if engine is None:
+            engine = self.engines[0]
+        elif engine not in self.engines:
+            raise ValueError('{} has no {} engine'.format(
+                             self.__class__.__name__, engine))
+        self.engine = engine
         self.cache_hits = 0
         self.cache_misses = 0
-        self.parse_tree_cache = {}
+        self.files_written = 0
+        self.files_skipped = 0
+        self.parse_tree_cache = TreeCache()
+        # equal keys and string values share one str across all trees this
+        # parser makes or loads from cache. emptied by a full flush, so the
+        # pool lives no longer than the trees it was filled for
+        self.intern_pool = {}
+        # see script_prefix
+        self.script_prefixes = {}
+        # disk cache entries read ahead of use, by cachepath
+        self.prefetched = {}
+        self.readahead = 8
         self.memcache_default = False
         self.diskcache_default = True
         self.tab_indents = True
@@ -745,19 +2213,35 @@ class SimpleParser:
         self.vanilla_is_repo = True
         self.cachedir = cachedir / self.__class__.__name__
         self.cachedir.mkdir(parents=True, exist_ok=True)
+        # or PackedCacheStore(self.cachedir) for a database file per repo
+        self.cache_store = DirCacheStore()
+        # or 'content' to key entries by file contents, see
+        # get_content_cachepath
+        self.cache_keys = 'git'
         self.setup_parser()
 
     def __del__(self):
         print('{}: {} hits, {} misses'.format(
               self.__class__.__name__, self.cache_hits, self.cache_misses),
               file=sys.stderr)
+        memcache = self.parse_tree_cache
+        if memcache.peak_nodes:
+            print('{} memcache: {} hits, {} evictions, {} trees of {} nodes '
+                  'resident (peak {} nodes)'.format(
+                  self.__class__.__name__, memcache.hits, memcache.evictions,
+                  len(memcache), memcache.nodes, memcache.peak_nodes),
+                  file=sys.stderr)
+        if self.files_written or self.files_skipped:
+            print('{}: {} files written, {} unchanged'.format(
+                  self.__class__.__name__, self.files_written,
+                  self.files_skipped), file=sys.stderr)
 
     def setup_parser(self):
         unarg = lambda f: lambda x: f(*x)
-        tokval = lambda x: x.value
-        toktype = lambda t: some(lambda x: x.type == t) >> tokval
-        kel = a(Token('Brace', '{')) >> tokval >> Op
-        ker = a(Token('Brace', '}')) >> tokval >> Op
+        tokval = lambda x: x[1]
+        toktype = lambda t: some(lambda x: x[0] == t) >> tokval
+        kel = a(('Brace', '{')) >> tokval >> Op
+        ker = a(('Brace', '}')) >> tokval >> Op
         op = toktype('Op') >> Op
         number = toktype('Number') >> Number
         date = toktype('Date') >> Date
@@ -775,7 +2259,10 @@ class SimpleParser:
 
     def flush(self, path=None):
         if path is None:
-            self.parse_tree_cache = {}
+            self.parse_tree_cache.clear()
+            # trees still held elsewhere keep their strings; only the sharing
+            # with trees made from here on is lost
+            self.intern_pool.clear()
         elif path in self.parse_tree_cache:
             del self.parse_tree_cache[path]
 
@@ -790,7 +2277,81 @@ class SimpleParser:
             if bad_repo_path != None:
                 del self.repos[bad_repo_path]
 
+    # with cache_keys == 'content', entries are named for the file's contents
+    # rather than its path, so they never go stale and need no git history
+    def get_content_cachepath(self, path, encoding):
+        digest = get_manifest(self.cachedir / 'manifest').digest(path)
+        m = hashlib.md5()
+        m.update(encoding.encode())
+        m.update(digest)
+        return self.cachedir / 'content' / m.hexdigest()
+
+    def scan_latest_commits(self, repo):
+        tracked_files = set(repo.git.ls_files(z=True).split('\x00')[:-1])
+        latest_commit = {}
+        log_output = repo.git.log('.', m=True, pretty='format:%h', z=True,
+                                  name_only=True)
+        log_iter = iter(log_output.split('\x00'))
+        for entry in log_iter:
+            try:
+                commit, file_str = entry.split('\n', maxsplit=1)
+            except ValueError:
+                continue
+            while file_str:
+                try:
+                    tracked_files.remove(file_str)
+                    latest_commit[file_str] = commit
+                except KeyError:
+                    pass
+                file_str = next(log_iter)
+            if not tracked_files:
+                break
+        return latest_commit
+
+    # the latest commit map only depends on HEAD, so it's saved under
+    # cachedir for the next process. when HEAD has moved, files that differ
+    # from the saved HEAD get the new HEAD as their commit, which keeps one
+    # commit per version of a file without walking the log again.
+    def latest_commits(self, repo):
+        try:
+            head = repo.head.commit.hexsha
+        except ValueError:
+            return self.scan_latest_commits(repo)
+        m = hashlib.md5()
+        m.update(repo.working_tree_dir.encode())
+        snapshot_path = cachedir / 'repos' / m.hexdigest()
+        try:
+            with snapshot_path.open('rb') as f:
+                old_head, latest_commit = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            old_head, latest_commit = None, None
+        if old_head == head:
+            return latest_commit
+        if old_head is not None:
+            try:
+                diff_output = repo.git.diff(old_head, head, name_status=True,
+                                            no_renames=True, z=True)
+            except git.GitCommandError:
+                latest_commit = None
+            else:
+                short_head = repo.git.rev_parse(head, short=True)
+                diff_iter = iter(diff_output.split('\x00')[:-1])
+                for status, file_str in zip(diff_iter, diff_iter):
+                    if status == 'D':
+                        latest_commit.pop(file_str, None)
+                    else:
+                        latest_commit[file_str] = short_head
+        if latest_commit is None:
+            latest_commit = self.scan_latest_commits(repo)
+        try:
+            write_atomic(snapshot_path, pickle.dumps((head, latest_commit)))
+        except OSError:
+            pass
+        return latest_commit
+
     def get_cachepath(self, path, encoding):
+        if self.cache_keys == 'content':
+            return self.get_content_cachepath(path, encoding), True
         m = hashlib.md5()
         m.update(encoding.encode())
         m.update(bytes(path))
@@ -818,25 +2379,7 @@ class SimpleParser:
                     return self.cachedir / 'vanilla' / name, False
                 return self.cachedir / name, False
             repo_path = pathlib.Path(repo.working_tree_dir)
-            tracked_files = set(repo.git.ls_files(z=True).split('\x00')[:-1])
-            latest_commit = {}
-            log_output = repo.git.log('.', m=True, pretty='format:%h', z=True,
-                                      name_only=True)
-            log_iter = iter(log_output.split('\x00'))
-            for entry in log_iter:
-                try:
-                    commit, file_str = entry.split('\n', maxsplit=1)
-                except ValueError:
-                    continue
-                while file_str:
-                    try:
-                        tracked_files.remove(file_str)
-                        latest_commit[file_str] = commit
-                    except KeyError:
-                        pass
-                    file_str = next(log_iter)
-                if not tracked_files:
-                    break
+            latest_commit = self.latest_commits(repo)
             dirty_paths = []
             status_output = repo.git.status(z=True)
             status_iter = iter(status_output.split('\x00')[:-1])
@@ -861,92 +2404,535 @@ class SimpleParser:
     def file(self, *args, **kwargs):
         return next(self.files(*args, **kwargs))
 
-    def parse_files(self, glob, basedir=None, moddirs=None, **kwargs):
+    # yields (path, facts) for each file matching glob, in files() order, with
+    # facts = derive(self, path, tree). only files changed since the last run
+    # under the same name are parsed, so facts must be picklable and depend on
+    # nothing but that file; change the name along with derive.
+    def file_facts(self, name, glob, derive, **kwargs):
+        paths = (path for path in self.files(glob) if path.is_file())
+        return self.path_facts(name, paths, derive, **kwargs)
+
+    # file_facts for a list of paths, so that callers can leave out files
+    # before anything is parsed
+    def path_facts(self, name, paths, derive, **kwargs):
+        fact_cache = get_fact_cache('{}.{}'.format(type(self).__name__, name))
+        for path in paths:
+            path = path.resolve()
+            yield path, fact_cache.facts(path, lambda: derive(
+                self, path, self.parse_file(path, **kwargs)))
+
+    # with workers > 1, cache misses are parsed in that many processes, which
+    # also write their disk cache entries. trees still come out in files()
+    # order, each one once it and everything before it is ready and a few
+    # paths per worker behind it have been started.
+    def parse_files(self, glob, basedir=None, moddirs=None, workers=None,
+                    **kwargs):
         if moddirs is None:
             moddirs = self.moddirs
         if basedir is None:
             basedir = self.basedir
-        for path in files(glob, moddirs, basedir=basedir):
-            if path.is_file():
-                yield path.resolve(), self.parse_file(path, **kwargs)
+        paths = [path.resolve()
+                 for path in files(glob, moddirs, basedir=basedir)
+                 if path.is_file()]
+        if kwargs.get('lazy'):
+            for path in paths:
+                yield path, self.parse_file(path, **kwargs)
+        elif workers is None or workers < 2:
+            encoding = kwargs.get('encoding') or self.encoding
+            errors = kwargs.get('errors', 'replace')
+            for path in self.read_ahead(paths, encoding, errors):
+                yield path, self.parse_file(path, **kwargs)
+        else:
+            yield from self.parse_paths_parallel(paths, workers, **kwargs)
+
+    # yields paths, while threads read the disk cache entries of the next
+    # readahead paths into self.prefetched for cached_tree to pick up
+    def read_ahead(self, paths, encoding, errors):
+        if self.ignore_cache or errors != 'replace' or not self.readahead:
+            yield from paths
+            return
+        scheduled = 0
+        cachepaths = []
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            try:
+                for i, path in enumerate(paths):
+                    end = min(i + 1 + self.readahead, len(paths))
+                    for ahead in paths[scheduled:end]:
+                        if ahead in self.parse_tree_cache:
+                            continue
+                        cachepath, is_indexed = self.get_cachepath(ahead,
+                                                                   encoding)
+                        cachepaths.append(cachepath)
+                        self.prefetched[cachepath] = pool.submit(
+                            self.read_cache, ahead, cachepath, is_indexed)
+                    scheduled = max(scheduled, end)
+                    yield path
+            finally:
+                for cachepath in cachepaths:
+                    self.prefetched.pop(cachepath, None)
+
+    # at most window paths are in flight past the one yielded next, so trees
+    # stream out as they do serially rather than piling up
+    def parse_paths_parallel(self, paths, workers, encoding=None,
+                             errors='replace', memcache=None, diskcache=None):
+        if memcache is None:
+            memcache = self.memcache_default
+        if diskcache is None:
+            diskcache = self.diskcache_default
+        if encoding is None:
+            encoding = self.encoding
+        ignore_cache = (self.ignore_cache or errors != 'replace')
+        window = 4 * workers
+        pending = collections.deque()
 
+        def finish(path, tree):
+            if isinstance(tree, concurrent.futures.Future):
+                try:
+                    data = tree.result()
+                except:
+                    print(path, file=sys.stderr)
+                    raise
+                if data is None:
+                    # not serializable, so parse it here instead
+                    tree = self.parse_path(path, encoding, errors)
+                else:
+                    tree = self.load_tree(io.BytesIO(data))
+                if not ignore_cache and memcache:
+                    self.parse_tree_cache[path] = tree
+            return path, tree
+
+        # a child forked while another thread holds a lock, sqlite's among
+        # them, can deadlock on it. so the workers start before any cache
+        # reads are in flight, and with the writer thread idle.
+        cache_writer.flush()
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=init_parse_worker,
+                initargs=(self.__class__, self.strict, self.engine,
+                          self.cache_store)) as pool:
+            pool.submit(int).result()
+            for path in self.read_ahead(paths, encoding, errors):
+                tree, cachepath = None, None
+                if not ignore_cache:
+                    tree, cachepath = self.cached_tree(path, encoding,
+                                                       memcache)
+                    if not diskcache:
+                        cachepath = None
+                if tree is None:
+                    tree = pool.submit(parse_in_worker, path, encoding,
+                                       errors, cachepath)
+                pending.append((path, tree))
+                if len(pending) > window:
+                    yield finish(*pending.popleft())
+            while pending:
+                yield finish(*pending.popleft())
+
+    # lazy=True returns a LazyTopLevel, which is neither cached nor taken
+    # from the disk cache, but a tree already in the memcache is used as is
     def parse_file(self, path, encoding=None, errors='replace',
-                   memcache=None, diskcache=None):
+                   memcache=None, diskcache=None, lazy=False):
         try:
             path = path.resolve()
         except AttributeError:
-            return self.parse_file(self.file(path),
-                                   encoding, errors, memcache, diskcache)
+            return self.parse_file(self.file(path), encoding, errors,
+                                   memcache, diskcache, lazy)
         if memcache is None:
             memcache = self.memcache_default
         if diskcache is None:
             diskcache = self.diskcache_default
         if encoding is None:
             encoding = self.encoding
-        ignore_cache = (self.ignore_cache or errors != 'replace')
-        if not ignore_cache:
+        if lazy:
             if path in self.parse_tree_cache:
                 return self.parse_tree_cache[path]
-            cachepath, is_indexed = self.get_cachepath(path, encoding)
-            try:
-                if cachepath.exists() and (is_indexed or
-                                           (os.path.getmtime(str(cachepath)) >=
-                                            os.path.getmtime(str(path)))):
-                    with cachepath.open('rb') as f:
-                        tree = pickle.load(f)
-                        if tree.version == VERSION:
-                            if memcache:
-                                self.parse_tree_cache[path] = tree
-                            self.cache_hits += 1
-                            return tree
-            except AttributeError:
-                pass
-            except (pickle.PickleError, EOFError, ImportError, IndexError):
-                print('Error retrieving cache for {}'.format(path),
-                      file=sys.stderr)
-                traceback.print_exc()
-                pass
-            self.cache_misses += 1
-        with path.open(encoding=encoding, errors=errors) as f:
-            try:
-                tree = self.parse(f.read())
-                if not ignore_cache:
-                    if diskcache:
-                        cachepath.parent.mkdir(parents=True, exist_ok=True)
-                        # possible todo: put this i/o in another thread
-                        with cachepath.open('wb') as f:
-                            tree.version = VERSION
-                            pickle.dump(tree, f)
+            with path.open(encoding=encoding, errors=errors) as f:
+                return self.parse_lazy(f.read())
+        ignore_cache = (self.ignore_cache or errors != 'replace')
+        if ignore_cache:
+            return self.parse_path(path, encoding, errors)
+        tree, cachepath = self.cached_tree(path, encoding, memcache)
+        if tree is None:
+            tree = self.parse_path(path, encoding, errors,
+                                   cachepath if diskcache else None)
+            if memcache:
+                self.parse_tree_cache[path] = tree
+        return tree
+
+    # returns the memcached or disk cached tree for path, or None on a miss,
+    # along with the disk cache path
+    def cached_tree(self, path, encoding, memcache):
+        if path in self.parse_tree_cache:
+            return self.parse_tree_cache[path], None
+        cachepath, is_indexed = self.get_cachepath(path, encoding)
+        try:
+            prefetch = self.prefetched.pop(cachepath, None)
+            if prefetch is not None:
+                data = prefetch.result()
+            else:
+                data = self.read_cache(path, cachepath, is_indexed)
+            if data is not None:
+                tree = self.load_tree(io.BytesIO(data))
+                if tree is not None and tree.version == VERSION:
                     if memcache:
                         self.parse_tree_cache[path] = tree
-                return tree
-            except:
-                print(path, file=sys.stderr)
-                raise
+                    self.cache_hits += 1
+                    return tree, cachepath
+        except AttributeError:
+            pass
+        except (pickle.PickleError, EOFError, ImportError, IndexError,
+                ValueError, sqlite3.Error):
+            print('Error retrieving cache for {}'.format(path),
+                  file=sys.stderr)
+            traceback.print_exc()
+            pass
+        self.cache_misses += 1
+        return None, cachepath
+
+    # entries for files outside a repo, or with uncommitted changes, must be
+    # newer than the file itself
+    def read_cache(self, path, cachepath, is_indexed):
+        min_mtime = None if is_indexed else os.path.getmtime(str(path))
+        return self.cache_store.read(cachepath, min_mtime)
+
+    def parse_path(self, path, encoding, errors, cachepath=None):
+        try:
+            if self.tokenizer.reads_bytes(encoding, errors):
+                tree = self.parse_bytes(path.read_bytes(), encoding)
+            else:
+                with path.open(encoding=encoding, errors=errors) as f:
+                    tree = self.parse(f.read())
+        except:
+            print(path, file=sys.stderr)
+            raise
+        if cachepath is not None:
+            self.write_cache(tree, cachepath)
+        return tree
+
+    # the tree is pickled here, since callers are free to modify it as soon
+    # as we return, and only the file i/o is left to the writer thread
+    def write_cache(self, tree, cachepath):
+        tree.version = VERSION
+        f = io.BytesIO()
+        try:
+            self.dump_tree(tree, f)
+        except (RecursionError, TypeError):
+            # nested too deep, or holding nodes or numbers the cache format
+            # doesn't know; parse it every time
+            return
+        cache_writer.put(self.cache_store, cachepath, f.getvalue())
+
+    # see tree_to_bytes. strings are interned through the parser's pool.
+    def dump_tree(self, tree, f):
+        f.write(tree_to_bytes(tree))
+
+    def load_tree(self, f):
+        with gc_paused():
+            return tree_from_bytes(f.read(), self.intern_pool)
+
+    # a LazyTopLevel, if the top level is a plain list of pairs. otherwise
+    # the string is parsed as usual, so that errors there are raised here.
+    # the scan only matches braces inside a braced value, so an error within
+    # one is raised by whatever first parses that pair, such as a lookup of
+    # its key or contents.
+    def parse_lazy(self, string):
+        with gc_paused():
+            spans = self.scan_toplevel(string)
+        if spans is None:
+            return self.parse(string)
+        return LazyTopLevel(self, string, spans)
+
+    # (key value, start, end) of each top-level pair, or None. braced values
+    # are skipped by counting braces rather than tokenized.
+    def scan_toplevel(self, string):
+        scanner = self.tokenizer.scanner
+        intern = self.intern_pool.setdefault
+        keys = {'Name': lambda s: intern(s, s), 'Number': str_to_number,
+                'Date': str_to_date}
+        values = {'Name', 'Number', 'Date', 'String'}
+        spans = []
+        pos = 0
+        while True:
+            m = scanner.match(string, pos)
+            if m is None:
+                return None
+            type = m.lastgroup
+            if type is None:
+                return spans
+            if type not in keys:
+                return None
+            key, start = keys[type](m.group(type)), m.start(type)
+            m = scanner.match(string, m.end())
+            if m is None or m.lastgroup != 'Op':
+                return None
+            m = scanner.match(string, m.end())
+            if m is None:
+                return None
+            type = m.lastgroup
+            if type == 'Brace' and m.group(type) == '{':
+                end = self.tokenizer.block_end(string, m.end())
+                if end is None:
+                    return None
+            elif type in values:
+                end = m.end()
+            else:
+                return None
+            spans.append((key, start, end))
+            pos = end
 
     def parse(self, string):
-        tokens = list(self.tokenizer.tokenize(string))
-        tree = self.toplevel.parse(tokens)
+        return self.parse_tokens(list(self.tokenizer.tokenize(string)))
+
+    # the tree parse would build from the bytes decoded as text. see
+    # tokenize_bytes.
+    def parse_bytes(self, data, encoding=None):
+        if encoding is None:
+            encoding = self.encoding
+        return self.parse_tokens(
+            list(self.tokenizer.tokenize_bytes(data, encoding)))
+
+    def parse_tokens(self, tokens):
+        with gc_paused():
+            if self.engine == 'stack':
+                tree = self.parse_stack(tokens)
+            else:
+                tree = self.toplevel.parse(tokens)
+        # roughly one node per token, for the memcache budget
+        tree.node_count = len(tokens)
         return tree
 
+    # same trees as the combinator grammar in setup_parser, but driven by a
+    # loop over the tokens with an explicit stack of open objects. a key
+    # followed by an op always starts a pair, so one token of lookahead
+    # decides every branch and nothing needs to backtrack.
+    def parse_stack(self, tokens):
+        intern = self.intern_pool.setdefault
+        name = lambda s: String(intern(s, s))
+        quoted = lambda s: name(s[1:-1])
+        leaves = {'Name': name, 'Number': Number, 'Date': Date}
+        contents = []
+        stack = []
+        i, n = 0, len(tokens)
+        while i < n:
+            type, value = tokens[i]
+            i += 1
+            leaf = leaves.get(type)
+            if leaf is not None:
+                if i < n and tokens[i][0] == 'Op':
+                    if i + 1 == n:
+                        raise NoParseError('got unexpected end of input', None)
+                    key, op = leaf(value), Op(tokens[i][1])
+                    type, value = tokens[i + 1]
+                    i += 2
+                    leaf = leaves.get(type)
+                    if leaf is not None:
+                        contents.append(Pair(key, op, leaf(value)))
+                        continue
+                    if type == 'String':
+                        contents.append(Pair(key, op, quoted(value)))
+                        continue
+                    if type == 'Brace' and value == '{':
+                        stack.append((contents, key, op, Op(value)))
+                        contents = []
+                        continue
+                elif stack:
+                    contents.append(leaf(value))
+                    continue
+            elif stack:
+                if type == 'String':
+                    contents.append(quoted(value))
+                    continue
+                if type == 'Brace' and value == '}':
+                    parent, key, op, kel = stack.pop()
+                    parent.append(Pair(key, op, Obj(kel, contents, Op(value))))
+                    contents = parent
+                    continue
+            raise NoParseError('got unexpected token: {!r}'.format(value), None)
+        if stack and self.strict:
+            raise NoParseError('got unexpected end of input', None)
+        while stack:
+            parent, key, op, kel = stack.pop()
+            parent.append(Pair(key, op, Obj(kel, contents)))
+            contents = parent
+        return TopLevel(contents)
+
+    # the file's tokens as a TokenSpans over a mapping of it, for scans that
+    # only look for certain tokens. comments are skipped, whatever the
+    # parser, and the file is read with errors='replace'.
+    @contextlib.contextmanager
+    def token_spans(self, path, encoding=None):
+        if encoding is None:
+            encoding = self.encoding
+        if not SimpleTokenizer.reads_bytes(encoding, 'replace'):
+            raise ValueError('no token spans for encoding {}'.format(encoding))
+        try:
+            path = path.resolve()
+        except AttributeError:
+            path = self.file(path).resolve()
+        with mapped(path) as data:
+            yield TokenSpans(data, encoding)
+
+    # the keys starting with one of prefixes of the pairs at the top level
+    # or in the contents of a pair whose key starts with one of descend
+    # (prefixes if None) that is itself in such contents, in file order.
+    # reads the file's token spans, decoding only the keys returned, but
+    # raises NoParseError where parse would.
+    def nested_keys(self, path, prefixes, descend=None, encoding=None):
+        if descend is None:
+            descend = prefixes
+        with self.token_spans(path, encoding) as tokens:
+            prefixes = tuple(p.encode(tokens.encoding) for p in prefixes)
+            descend = tuple(p.encode(tokens.encoding) for p in descend)
+            data = tokens.data
+            leaves = {'Name', 'Number', 'Date'}
+            values = {'Name', 'Number', 'Date', 'String'}
+            # for each open object, whether its pairs are walked
+            walked = []
+            keys = []
+            spans = iter(tokens)
+            span = next(spans, None)
+            while span is not None:
+                type, start, end = span
+                span = next(spans, None)
+                if type in leaves and span is not None and span[0] == 'Op':
+                    value = next(spans, None)
+                    if value is None:
+                        raise NoParseError('got unexpected end of input', None)
+                    span = next(spans, None)
+                    key = data[start:end]
+                    walk = not walked or walked[-1]
+                    if walk and key.startswith(prefixes):
+                        keys.append(tokens.text(start, end))
+                    type, start, end = value
+                    if type in values:
+                        continue
+                    if type == 'Brace' and data[start] == ord('{'):
+                        walked.append(walk and key.startswith(descend))
+                        continue
+                elif walked:
+                    if type in values:
+                        continue
+                    if type == 'Brace' and data[start] == ord('}'):
+                        walked.pop()
+                        continue
+                raise NoParseError('got unexpected token: {!r}'.format(
+                                   tokens.text(start, end)), None)
+            if walked and self.strict:
+                raise NoParseError('got unexpected end of input', None)
+        return keys
+
+    # a single pass over a file without building its tree. see events.
+    def iter_events(self, path, encoding=None, errors='replace'):
+        try:
+            path = path.resolve()
+        except AttributeError:
+            path = self.file(path).resolve()
+        if encoding is None:
+            encoding = self.encoding
+        if SimpleTokenizer.reads_bytes(encoding, errors):
+            tokens = SimpleTokenizer.tokenize_bytes(path.read_bytes(),
+                                                    encoding)
+        else:
+            with path.open(encoding=encoding, errors=errors) as f:
+                tokens = SimpleTokenizer.tokenize(f.read())
+        yield from self.token_events(tokens)
+
+    # yields (event, value, depth) in the order parse_stack reads the tokens:
+    # 'key', 'op' and 'value' for the parts of each pair and for bare values,
+    # with values converted as in trees, and 'begin' and 'end' around the
+    # contents of each object. depth is the number of objects enclosing the
+    # event, so 'begin' and 'end' have the depth of their pair's key. comments
+    # are skipped, whatever the parser.
+    def events(self, string):
+        return self.token_events(SimpleTokenizer.tokenize(string))
+
+    def token_events(self, tokens):
+        intern = self.intern_pool.setdefault
+        name = lambda s: intern(s, s)
+        leaves = {'Name': name, 'Number': str_to_number, 'Date': str_to_date}
+        depth = 0
+        token = next(tokens, None)
+        while token is not None:
+            type, value = token
+            token = next(tokens, None)
+            leaf = leaves.get(type)
+            if leaf is not None:
+                if token is not None and token[0] == 'Op':
+                    yield 'key', leaf(value), depth
+                    yield 'op', token[1], depth
+                    token = next(tokens, None)
+                    if token is None:
+                        raise NoParseError('got unexpected end of input', None)
+                    type, value = token
+                    token = next(tokens, None)
+                    leaf = leaves.get(type)
+                    if leaf is not None:
+                        yield 'value', leaf(value), depth
+                        continue
+                    if type == 'String':
+                        yield 'value', name(value[1:-1]), depth
+                        continue
+                    if type == 'Brace' and value == '{':
+                        yield 'begin', None, depth
+                        depth += 1
+                        continue
+                elif depth:
+                    yield 'value', leaf(value), depth
+                    continue
+            elif depth:
+                if type == 'String':
+                    yield 'value', name(value[1:-1]), depth
+                    continue
+                if type == 'Brace' and value == '}':
+                    depth -= 1
+                    yield 'end', None, depth
+                    continue
+            raise NoParseError('got unexpected token: {!r}'.format(value), None)
+        if depth and self.strict:
+            raise NoParseError('got unexpected end of input', None)
+        while depth:
+            depth -= 1
+            yield 'end', None, depth
+
+    # leaves the file alone if it already holds exactly what would be
+    # written, so its mtime and any cache entries for it stay valid. returns
+    # whether it was written.
     def write(self, tree, path):
-        path.parent.mkdir(parents=True, exist_ok=True)
         try:
-            with path.open('w', encoding=self.encoding,
-                           newline=('\r\n' if self.crlf else '\n')) as f:
-                f.write(tree.str(self))
+            text = tree.str(self)
+            if self.crlf:
+                text = text.replace('\n', '\r\n')
+            data = text.encode(self.encoding)
+            manifest = get_manifest(self.cachedir / 'manifest')
+            try:
+                if (os.path.getsize(str(path)) == len(data) and
+                    manifest.digest(path) == hashlib.blake2b(
+                        data, digest_size=16).digest()):
+                    self.files_skipped += 1
+                    return False
+            except OSError:
+                pass
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open('wb') as f:
+                f.write(data)
+            manifest.record(path, data)
         except:
             print(path)
             raise
+        self.files_written += 1
+        return True
 
 class FullParser(SimpleParser):
     tokenizer = FullTokenizer
 
+    # comments belong to the tokens around them, so the top level can't be
+    # split up without tokenizing it all
+    def parse_lazy(self, string):
+        return self.parse(string)
+
     def setup_parser(self):
         unarg = lambda f: lambda x: f(*x)
         unquote = lambda s: s[1:-1]
-        tokval = lambda x: x.value
-        toktype = lambda t: some(lambda x: x.type == t) >> tokval
+        tokval = lambda x: x[1]
+        toktype = lambda t: some(lambda x: x[0] == t) >> tokval
         nl = skip(many(toktype('newline')))
         end = nl + skip(finished)
         comment = toktype('comment')
@@ -955,8 +2941,8 @@ class FullParser(SimpleParser):
                            unarg(String))
         quoted_string = (commented(toktype('quoted_string') >> unquote) >>
                          unarg(String))
-        kel = commented(a(Token('brace', '{')) >> tokval) >> unarg(Op)
-        ker = commented(a(Token('brace', '}')) >> tokval) >> unarg(Op)
+        kel = commented(a(('brace', '{')) >> tokval) >> unarg(Op)
+        ker = commented(a(('brace', '}')) >> tokval) >> unarg(Op)
         op = commented(toktype('op')) >> unarg(Op)
         number = commented(toktype('number')) >> unarg(Number)
         date = commented(toktype('date')) >> unarg(Date)
@@ -970,3 +2956,223 @@ class FullParser(SimpleParser):
         value.define(obj | key | quoted_string)
         self.toplevel = (many(pair) + many(nl + comment) + end >>
                          unarg(TopLevel))
+
+    # the grammar above gives every token the comments on the lines before it
+    # and the comment directly after it on the same line. this runs like
+    # SimpleParser.parse_stack, except that objects may also hold bare
+    # objects, in one pass that also hands out the comments: each node is
+    # made as soon as its token is seen, with the comments waiting before it,
+    # and a comment later on its line becomes its post comment. a key or bare
+    # value is the same node either way, so it's made before the next token
+    # says which it is.
+    def parse_stack(self, tokens):
+        intern = self.intern_pool.setdefault
+        leaves = {'unquoted_string': String, 'number': Number, 'date': Date}
+        contents = []
+        stack = []
+        comments = []
+        # the node a comment on the same line would follow
+        last = None
+        # a key or value waiting on the next token, and the op after a key
+        leaf = op = None
+        for type, value in tokens:
+            if type == 'comment':
+                if last is not None:
+                    last.post_comment = Comment(value)
+                    last = None
+                else:
+                    comments.append(value)
+                continue
+            if type == 'newline':
+                last = None
+                continue
+            node_type = leaves.get(type)
+            if node_type is not None or type == 'quoted_string':
+                if type == 'quoted_string':
+                    node_type = String
+                    value = value[1:-1]
+                if type != 'number' and type != 'date':
+                    value = intern(value, value)
+                if comments:
+                    node = node_type(comments, value, None)
+                    comments = []
+                else:
+                    node = node_type(value)
+            else:
+                if comments:
+                    node = Op(comments, value, None)
+                    comments = []
+                else:
+                    node = Op(value)
+            last = node
+            if op is not None:
+                if node_type is not None:
+                    contents.append(Pair(leaf, op, node))
+                elif value == '{':
+                    stack.append((contents, leaf, op, node))
+                    contents = []
+                else:
+                    raise NoParseError('got unexpected token: {!r}'.format(
+                                       value), None)
+                leaf = op = None
+                continue
+            if leaf is not None:
+                if type == 'op':
+                    op = node
+                    continue
+                if not stack:
+                    raise NoParseError('got unexpected token: {!r}'.format(
+                                       leaf.val), None)
+                contents.append(leaf)
+                leaf = None
+            if node_type is not None:
+                if type == 'quoted_string':
+                    if not stack:
+                        raise NoParseError('got unexpected token: {!r}'.format(
+                                           '"{}"'.format(value)), None)
+                    contents.append(node)
+                else:
+                    leaf = node
+            elif stack and value == '{':
+                stack.append((contents, None, None, node))
+                contents = []
+            elif stack and value == '}':
+                parent, key, key_op, kel = stack.pop()
+                obj = Obj(kel, contents, node)
+                parent.append(obj if key is None else Pair(key, key_op, obj))
+                contents = parent
+            else:
+                raise NoParseError('got unexpected token: {!r}'.format(value),
+                                   None)
+        if op is not None:
+            raise NoParseError('got unexpected end of input', None)
+        if leaf is not None:
+            if not stack:
+                raise NoParseError('got unexpected token: {!r}'.format(
+                                   leaf.val), None)
+            contents.append(leaf)
+        if stack:
+            # comments can't come between the last item and the end of input
+            if self.strict or comments:
+                raise NoParseError('got unexpected end of input', None)
+            while stack:
+                parent, key, key_op, kel = stack.pop()
+                obj = Obj(kel, contents)
+                parent.append(obj if key is None else Pair(key, key_op, obj))
+                contents = parent
+        return TopLevel(contents, comments)
+
+
+# builds ColumnarTrees instead of node trees, for scripts that only read
+# them. the views have no comments and can't be written back out.
+class ColumnarParser(SimpleParser):
+    engines = ['stack']
+
+    def parse_lazy(self, string):
+        return self.parse(string)
+
+    # columnar trees are flat arrays already, so they stay pickled. a cache
+    # entry is a pickled list of the tree's strings followed by the tree,
+    # pickled with each string replaced by its index in the list. that way a
+    # load interns each distinct string once rather than per use.
+    def dump_tree(self, tree, f):
+        ids = {}
+        def persistent_id(obj):
+            if obj.__class__ is str:
+                return ids.setdefault(obj, len(ids))
+            return None
+        tree_pickle = io.BytesIO()
+        pickler = pickle.Pickler(tree_pickle)
+        pickler.persistent_id = persistent_id
+        with gc_paused():
+            pickler.dump(tree)
+        pickle.dump(list(ids), f)
+        f.write(tree_pickle.getbuffer())
+
+    def load_tree(self, f):
+        strings = pickle.load(f)
+        if not isinstance(strings, list):
+            return None
+        intern = self.intern_pool.setdefault
+        strings = [intern(s, s) for s in strings]
+        unpickler = pickle.Unpickler(f)
+        unpickler.persistent_load = strings.__getitem__
+        with gc_paused():
+            return unpickler.load()
+
+    def parse_stack(self, tokens):
+        converters = {'Name': str, 'String': lambda s: s[1:-1],
+                      'Number': str_to_number, 'Date': str_to_date}
+        tree = ColumnarTree()
+        kind, parent, keys, values, end = (tree.kind, tree.parent, tree.key,
+                                           tree.value, tree.end)
+        intern = self.intern_pool.setdefault
+        token_ids = {}
+        value_ids = {}
+        def value_id(type, value):
+            try:
+                return token_ids[type, value]
+            except KeyError:
+                val = converters[type](value)
+                if val.__class__ is str:
+                    val = intern(val, val)
+                # 1, 1.0 and True are equal keys; keep them apart by type
+                id = value_ids.setdefault((val.__class__, val), len(value_ids))
+                if id == len(tree.values):
+                    tree.values.append(val)
+                token_ids[type, value] = id
+                return id
+        scalar, obj = ColumnarTree.SCALAR, ColumnarTree.OBJ
+        current = -1
+        i, n = 0, len(tokens)
+        while i < n:
+            type, value = tokens[i]
+            i += 1
+            if type in converters and type != 'String':
+                if i < n and tokens[i][0] == 'Op':
+                    if i + 1 == n:
+                        raise NoParseError('got unexpected end of input', None)
+                    key = value_id(type, value)
+                    type, value = tokens[i + 1]
+                    i += 2
+                    if type in converters:
+                        kind.append(scalar)
+                        parent.append(current)
+                        keys.append(key)
+                        values.append(value_id(type, value))
+                        end.append(len(end) + 1)
+                        continue
+                    if type == 'Brace' and value == '{':
+                        kind.append(obj)
+                        parent.append(current)
+                        keys.append(key)
+                        values.append(-1)
+                        current = len(end)
+                        end.append(0)
+                        continue
+                elif current >= 0:
+                    kind.append(scalar)
+                    parent.append(current)
+                    keys.append(-1)
+                    values.append(value_id(type, value))
+                    end.append(len(end) + 1)
+                    continue
+            elif current >= 0:
+                if type == 'String':
+                    kind.append(scalar)
+                    parent.append(current)
+                    keys.append(-1)
+                    values.append(value_id(type, value))
+                    end.append(len(end) + 1)
+                    continue
+                if type == 'Brace' and value == '}':
+                    end[current] = len(end)
+                    current = parent[current]
+                    continue
+            raise NoParseError('got unexpected token: {!r}'.format(value), None)
+        if current >= 0 and self.strict:
+            raise NoParseError('got unexpected end of input', None)
+        while current >= 0:
+            end[current] = len(end)
+            current = parent[current]
+        return tree
@@ -8,7 +8,8 @@ import shutil
 import tempfile
 import time
 from ck2parser import (rootpath, is_codename, get_province_id_name_map,
-                       get_provinces, get_localisation, get_cultures,
+                       get_provinces, get_localisation_index,
+                       get_cultures,
                        files, prepend_post_comment, Obj, Comment, SimpleParser,
                        FullParser)
 from print_time import print_time
@@ -57,7 +58,7 @@ def main():
     lt = modpath / 'common/landed_titles'
     province_id, used_baronies, max_settlements = process_province_history(
         simple_parser)
-    localisation = get_localisation(simple_parser.moddirs)
+    localisation = get_localisation_index(simple_parser.moddirs)
     cultures = get_cultures(simple_parser, groups=False)
     full_parser.fq_keys = cultures
     historical_baronies = []
@@ -6,8 +6,8 @@ import pathlib
 import re
 import shutil
 import tempfile
-from ck2parser import (rootpath, vanilladir, csv_rows, files, is_codename,
-                       get_cultures, get_localisation, SimpleParser)
+from ck2parser import (rootpath, vanilladir, is_codename, get_cultures,
+                       get_localisation_index, Obj, SimpleParser)
 from print_time import print_time
 
 modpath = rootpath / 'SWMH-BETA/SWMH'
@@ -18,42 +18,50 @@ def abbrev_path(path):
     return prefix + '/' + path.name
 
 def get_locs(where):
-    locs = collections.OrderedDict()
+    index = get_localisation_index(where)
+    locs = {}
     dupe_lines = []
-    for path in files('localisation/*.csv', where):
+    for key, value, path, linenum in index.rows():
         vanilla = modpath not in path.parents
-        for row, linenum in csv_rows(path, linenum=True):
-            if row[0] in locs:
-                # don't care about overriding vanilla
-                if not vanilla:
-                    line = ('{0!r} localisation at {1[1]!r}:{1[2]} '
-                        'overrides {2!r}:{3}\n'.format(row[0],
-                        locs[row[0]], abbrev_path(path), linenum))
-                    dupe_lines.append(line)
-            else:
-                locs[row[0]] = row[1], abbrev_path(path), linenum
-    locs = collections.OrderedDict((k, v[0]) for k, v in locs.items())
-    return locs, dupe_lines
+        if key in locs:
+            # don't care about overriding vanilla
+            if not vanilla:
+                line = ('{0!r} localisation at {1[0]!r}:{1[1]} '
+                    'overrides {2!r}:{3}\n'.format(key, locs[key],
+                    abbrev_path(path), linenum))
+                dupe_lines.append(line)
+        else:
+            locs[key] = abbrev_path(path), linenum
+    return index.dict(ordered=True), dupe_lines
 
-def scan_landed_titles(parser, cultures, loc_mod):
-    dynamics = collections.defaultdict(dict)
-    undef = collections.defaultdict(list)
+# each title a landed_titles file defines, with its (key, value) pairs
+def landed_title_pairs(parser, path, tree):
+    facts = []
 
     def recurse(tree):
         for n, v in tree:
             if is_codename(n.val):
-                for n2, v2 in v:
-                    if n2.val in cultures:
-                        dynamics[n.val][n2.val] = v2.val
-                    elif (n2.val in ['title', 'title_female', 'foa',
-                                     'title_prefix'] and
-                          v2.val not in loc_mod):
-                        undef[v2.val].append((n.val, n2.val))
+                facts.append((n.val, [(n2.val, v2.val) for n2, v2 in v
+                                      if not isinstance(v2, Obj)]))
                 recurse(v)
 
-    for path, tree in parser.parse_files('common/landed_titles/*.txt'):
-        print(path)
-        recurse(tree)
+    print(path)
+    recurse(tree)
+    return facts
+
+def scan_landed_titles(parser, cultures, loc_mod):
+    dynamics = collections.defaultdict(dict)
+    undef = collections.defaultdict(list)
+    for path, facts in parser.file_facts(
+            'landed_title_pairs', 'common/landed_titles/*.txt',
+            landed_title_pairs):
+        for title, pairs in facts:
+            for key, value in pairs:
+                if key in cultures:
+                    dynamics[title][key] = value
+                elif (key in ['title', 'title_female', 'foa',
+                              'title_prefix'] and value not in loc_mod):
+                    undef[value].append((title, key))
     return dynamics, undef
 
 @print_time
@@ -66,7 +74,7 @@ def main():
     # province_title.update(province_title_mod)
     cultures, cult_group = get_cultures(parser)
     mod_loc, dupe_lines = get_locs(parser.moddirs)
-    vanilla_loc = get_localisation()
+    vanilla_loc = get_localisation_index()
     # localisation = vanilla_loc.copy()
     # localisation.update(mod_loc)
     dynamics, undef = scan_landed_titles(parser, cultures, mod_loc)
@@ -10,7 +10,7 @@ Scans for:
 import pathlib
 import re
 from ck2parser import (rootpath, files, csv_rows, get_cultures, is_codename,
-                       get_localisation, SimpleParser, FullParser, NoParseError)
+                       get_localisation_index, SimpleParser, FullParser, NoParseError)
 from print_time import print_time
 
 modpath = rootpath / 'SWMH-BETA/SWMH'
@@ -56,7 +56,7 @@ def main():
         for title, defined in recurse(simple_parser, tree):
             (defined_titles if defined else commented_out_titles).append(title)
     titles = set(defined_titles) | set(commented_out_titles)
-    localisation = get_localisation(simple_parser.moddirs)
+    localisation = get_localisation_index(simple_parser.moddirs)
     unlocalised_noncounty_titles = [
         t for t in defined_titles
         if not t.startswith('c') and t not in localisation and t != 'e_null']
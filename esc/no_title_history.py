@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import re
 from ck2parser import rootpath, SimpleParser
 from print_time import print_time
 
@@ -9,14 +8,9 @@ from print_time import print_time
 def main():
     parser = SimpleParser(rootpath / 'SWMH-BETA/SWMH')
     counties = []
-    for _, tree in parser.parse_files('common/landed_titles/*.txt'):
-        dfs = list(reversed(tree))
-        while dfs:
-            n, v = dfs.pop()
-            if re.match('[ekd]_', n.val):
-                dfs.extend(reversed(v))
-            elif n.val.startswith('c_'):
-                counties.append(n.val)
+    for path in parser.files('common/landed_titles/*.txt'):
+        counties.extend(parser.nested_keys(path, ['c_'],
+                                           descend=['e_', 'k_', 'd_']))
     for path in parser.files('history/titles/*.txt'):
         try:
             counties.remove(path.stem)
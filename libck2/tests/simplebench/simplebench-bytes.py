@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+# checks that SimpleParser builds the same tree from the undecoded bytes of the
+# simplebench input as from the file read in text mode, and compares the time
+# and peak memory of the two.
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from ck2parser import SimpleParser, SimpleTokenizer
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+encoding = 'cp1252'
+
+def read_text():
+    with in_path.open(encoding=encoding, errors='replace') as f:
+        return f.read()
+
+def text_tokens():
+    return list(SimpleTokenizer.tokenize(read_text()))
+
+def byte_tokens():
+    return list(SimpleTokenizer.tokenize_bytes(in_path.read_bytes(),
+                                               encoding))
+
+def run(f):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+# timed without tracemalloc, which slows down allocation-heavy code unevenly
+def time_only(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+expected, _, text_peak = run(text_tokens)
+actual, _, bytes_peak = run(byte_tokens)
+for i, (x, y) in enumerate(zip(expected, actual)):
+    if x != y:
+        sys.exit('token {} differs: expected {}, got {}'.format(i, x, y))
+if len(expected) != len(actual):
+    sys.exit('token count differs: expected {}, got {}'.format(
+             len(expected), len(actual)))
+print('{} tokens identical'.format(len(actual)))
+
+parser = SimpleParser()
+if (parser.parse(read_text()).str(parser) !=
+        parser.parse_bytes(in_path.read_bytes()).str(parser)):
+    sys.exit('trees differ')
+print('trees identical')
+
+text_time = time_only(lambda: parser.parse(read_text()))
+bytes_time = time_only(lambda: parser.parse_bytes(in_path.read_bytes()))
+print('text:  {:.2f} s, tokenizing peak {:.1f} MB'.format(
+      text_time, text_peak / 2**20))
+print('bytes: {:.2f} s, tokenizing peak {:.1f} MB'.format(
+      bytes_time, bytes_peak / 2**20))
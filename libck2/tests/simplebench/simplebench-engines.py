@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# times each parse engine of SimpleParser and FullParser on the simplebench
+# input, checks that they build identical trees, and then parses a block
+# nested deeper than Python's recursion limit allows the combinators to go.
+
+import sys
+import time
+from pathlib import Path
+from ck2parser import (SimpleParser, FullParser, TopLevel, Pair, Obj,
+                       Commented, NoParseError)
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+
+def comment_vals(comments):
+    return [c.val for c in comments] if comments else []
+
+def node_key(node):
+    if isinstance(node, Commented):
+        post = node.post_comment.val if node.post_comment else None
+        return (type(node), node.val, comment_vals(node.pre_comments), post)
+    if isinstance(node, TopLevel):
+        return TopLevel, len(node), comment_vals(node.post_comments)
+    return type(node), len(node) if isinstance(node, Obj) else None
+
+def children(node):
+    if isinstance(node, Pair):
+        return [node.key, node.op, node.value]
+    if isinstance(node, Obj):
+        return [node.kel] + list(node) + [node.ker]
+    if isinstance(node, TopLevel):
+        return list(node)
+    return []
+
+# iterative, so it can compare trees too deep to recurse over
+def same_tree(x, y):
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        if node_key(x) != node_key(y):
+            return False
+        stack.extend(zip(children(x), children(y)))
+    return True
+
+def run(parser_class, engine, string):
+    parser = parser_class(engine=engine)
+    start = time.perf_counter()
+    try:
+        result = parser.parse(string)
+    except (RecursionError, NoParseError) as e:
+        result = e.__class__.__name__
+    return result, time.perf_counter() - start
+
+def describe(result):
+    return result if isinstance(result, str) else 'ok'
+
+for parser_class in [SimpleParser, FullParser]:
+    name = parser_class.__name__
+    results = {}
+    for engine in parser_class.engines:
+        results[engine], elapsed = run(parser_class, engine, text)
+        print('{} {}: {:.2f} s, {}'.format(
+              name, engine, elapsed, describe(results[engine])))
+    expected = results['stack']
+    for engine, result in results.items():
+        # running out of stack is what the stack engine is for
+        if result == 'RecursionError':
+            continue
+        if isinstance(result, str) or isinstance(expected, str):
+            agree = result == expected
+        else:
+            agree = same_tree(expected, result)
+        if not agree:
+            sys.exit('{} {}: result differs from stack engine'.format(
+                     name, engine))
+
+depth = 100000
+nested = 'a = { ' * depth + 'b = c' + ' }' * depth
+for parser_class in [SimpleParser, FullParser]:
+    for engine in parser_class.engines:
+        result, elapsed = run(parser_class, engine, nested)
+        print('{} {}, depth {}: {:.2f} s, {}'.format(
+              parser_class.__name__, engine, depth, elapsed, describe(result)))
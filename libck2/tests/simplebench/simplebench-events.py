@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+# checks SimpleParser.events against the tree parsed from the simplebench
+# input, event for event, and times counting the keys both ways.
+
+import collections
+import sys
+import time
+from pathlib import Path
+from ck2parser import SimpleParser, Pair, Obj
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+
+parser = SimpleParser()
+
+# events first, so that the collector isn't walking the full tree meanwhile
+start = time.perf_counter()
+event_counts = collections.Counter(value for event, value, _ in
+                                   parser.events(text) if event == 'key')
+event_time = time.perf_counter() - start
+
+start = time.perf_counter()
+tree = parser.parse(text)
+tree_counts = collections.Counter()
+stack = list(reversed(tree.contents))
+while stack:
+    item = stack.pop()
+    if isinstance(item, Pair):
+        tree_counts[item.key.val] += 1
+        if isinstance(item.value, Obj):
+            stack.extend(reversed(item.value.contents))
+tree_time = time.perf_counter() - start
+
+# the events a tree stands for, in order
+def tree_events(tree):
+    stack = [(item, 0) for item in reversed(tree.contents)]
+    while stack:
+        item, depth = stack.pop()
+        if item is None:
+            yield 'end', None, depth
+        elif isinstance(item, Pair):
+            yield 'key', item.key.val, depth
+            yield 'op', item.op.val, depth
+            if isinstance(item.value, Obj):
+                yield 'begin', None, depth
+                stack.append((None, depth))
+                stack.extend((x, depth + 1)
+                             for x in reversed(item.value.contents))
+            else:
+                yield 'value', item.value.val, depth
+        else:
+            yield 'value', item.val, depth
+
+n = 0
+for n, (x, y) in enumerate(zip(tree_events(tree), parser.events(text)), 1):
+    if x != y:
+        sys.exit('event {} differs: expected {}, got {}'.format(n, x, y))
+if n != sum(1 for _ in parser.events(text)):
+    sys.exit('event count differs')
+if event_counts != tree_counts:
+    sys.exit('key counts differ')
+
+print('{} events identical'.format(n))
+print('parse and walk tree: {:.2f} s'.format(tree_time))
+print('events:              {:.2f} s ({:.1f}x)'.format(
+      event_time, tree_time / event_time))
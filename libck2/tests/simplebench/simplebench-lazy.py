@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# checks that a LazyTopLevel gives the same pairs as a full parse of the
+# simplebench input, and times a full parse against a lazy parse followed by
+# looking up a single key. also checks where a malformed braced value is
+# reported: not by parse_lazy but by the first lookup of its key.
+
+import sys
+import time
+from pathlib import Path
+from ck2parser import SimpleParser, LazyTopLevel, NoParseError
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+
+parser = SimpleParser()
+
+# lazy first, so that the collector isn't walking the full tree meanwhile
+start = time.perf_counter()
+lazy = parser.parse_lazy(text)
+if not isinstance(lazy, LazyTopLevel):
+    sys.exit('top level could not be scanned')
+key = lazy.spans[len(lazy) // 2][0]
+value = lazy[key]
+lazy_time = time.perf_counter() - start
+
+start = time.perf_counter()
+tree = parser.parse(text)
+full_time = time.perf_counter() - start
+
+if value.str(parser) != tree[key].str(parser):
+    sys.exit('value of {!r} differs'.format(key))
+for i, (x, y) in enumerate(zip(tree, parser.parse_lazy(text))):
+    if x.str(parser) != y.str(parser):
+        sys.exit('pair {} differs'.format(i))
+if len(lazy) != len(tree):
+    sys.exit('pair count differs: expected {}, got {}'.format(
+             len(tree), len(lazy)))
+
+print('{} pairs identical'.format(len(tree)))
+
+malformed = 'a = 1\nb = { c = }\nd = { e = f }\n'
+lazy = parser.parse_lazy(malformed)
+if not isinstance(lazy, LazyTopLevel):
+    sys.exit('malformed block rejected by the scan')
+expected = parser.parse('d = { e = f }')['d'].str(parser)
+if lazy['a'].val != 1 or lazy['d'].str(parser) != expected:
+    sys.exit('well-formed pairs beside a malformed block differ')
+try:
+    lazy['b']
+except NoParseError:
+    print('malformed block raises on lookup')
+else:
+    sys.exit('malformed block parsed')
+
+print('full parse:        {:.2f} s'.format(full_time))
+print('lazy parse + [{!r}]: {:.3f} s ({:.0f}x)'.format(
+      key, lazy_time, full_time / lazy_time))
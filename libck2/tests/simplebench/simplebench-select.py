@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+# checks find_all and select on the tree parsed from the simplebench input
+# against plain recursive walks, and times a batch of lookups both ways. then
+# checks them on lazy trees, both before and after their contents are read.
+
+import sys
+import time
+from pathlib import Path
+from ck2parser import SimpleParser, Pair, Obj
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+
+parser = SimpleParser()
+tree = parser.parse(text)
+
+def walk(contents, depth=0):
+    for item in contents:
+        if isinstance(item, Pair):
+            yield item, depth
+            if isinstance(item.value, Obj):
+                yield from walk(item.value.contents, depth + 1)
+
+def walk_find_all(key, tree=tree):
+    return [pair for pair, _ in walk(tree.contents) if pair.key.val == key]
+
+def walk_select(path, tree=tree):
+    def matches(contents, path):
+        for item in contents:
+            if isinstance(item, Pair) and path[0] in ('*', item.key.val):
+                if len(path) == 1:
+                    yield item
+                elif isinstance(item.value, Obj):
+                    yield from matches(item.value.contents, path[1:])
+    return list(matches(tree.contents, path))
+
+keys = sorted({pair.key.val for pair, _ in walk(tree.contents)}, key=str)[:20]
+paths = [['*', key] for key in keys] + [['*', '*', key] for key in keys]
+
+start = time.perf_counter()
+walk_results = ([walk_find_all(key) for key in keys] +
+                [walk_select(path) for path in paths])
+walk_time = time.perf_counter() - start
+
+start = time.perf_counter()
+index_results = ([tree.find_all(key) for key in keys] +
+                 [tree.select(path) for path in paths])
+index_time = time.perf_counter() - start
+
+for query, x, y in zip(keys + paths, walk_results, index_results):
+    if [id(p) for p in x] != [id(p) for p in y]:
+        sys.exit('results for {!r} differ'.format(query))
+if tree.select('*/*') != walk_select(['*', '*']):
+    sys.exit('results for */* differ')
+
+print('{} queries identical'.format(len(walk_results)))
+print('recursive walks:      {:.2f} s'.format(walk_time))
+print('index, incl. build:   {:.2f} s ({:.0f}x)'.format(
+      index_time, walk_time / index_time))
+
+for read_first in [False, True]:
+    lazy = parser.parse_lazy(text)
+    if read_first:
+        lazy.contents
+    lazy_results = ([lazy.find_all(key) for key in keys] +
+                    [lazy.select(path) for path in paths])
+    walk_results = ([walk_find_all(key, lazy) for key in keys] +
+                    [walk_select(path, lazy) for path in paths])
+    for query, x, y in zip(keys + paths, walk_results, lazy_results):
+        if [id(p) for p in x] != [id(p) for p in y]:
+            sys.exit('lazy results for {!r} differ'.format(query))
+print('lazy tree queries identical')
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+# compares the binary tree format used for the disk cache with pickle
+# protocols 2, 4 and 5 on the simplebench input: size, dump and load times,
+# and that every format gives back the same tree. trees are compared through
+# their binary form, which covers every node, value and comment.
+
+import pickle
+import sys
+import time
+from pathlib import Path
+from ck2parser import (SimpleParser, FullParser, gc_paused, tree_to_bytes,
+                       tree_from_bytes)
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+
+def timed(f, *args):
+    start = time.perf_counter()
+    with gc_paused():
+        result = f(*args)
+    return result, time.perf_counter() - start
+
+formats = [('binary', tree_to_bytes, lambda b: tree_from_bytes(b, {}))]
+for protocol in [2, 4, 5]:
+    formats.append(('pickle {}'.format(protocol),
+                    lambda t, p=protocol: pickle.dumps(t, p), pickle.loads))
+
+for parser_class in [SimpleParser, FullParser]:
+    parser = parser_class()
+    try:
+        tree = parser.parse(text)
+    except Exception as e:
+        print('{}: {}'.format(parser_class.__name__, e.__class__.__name__))
+        continue
+    expected = tree_to_bytes(tree)
+    for name, dump, load in formats:
+        try:
+            data, dump_time = timed(dump, tree)
+        except RecursionError:
+            print('{} {}: RecursionError'.format(parser_class.__name__, name))
+            continue
+        loaded, load_time = timed(load, data)
+        if tree_to_bytes(loaded) != expected:
+            sys.exit('{} {}: tree differs after loading'.format(
+                     parser_class.__name__, name))
+        print('{} {:8}: {:6.2f} MB, dump {:.2f} s, load {:.2f} s'.format(
+              parser_class.__name__, name, len(data) / 2 ** 20, dump_time,
+              load_time))
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+# checks that the token spans of the simplebench input cover the same tokens
+# as the byte tokenizer, and times finding every key that starts with a title
+# prefix from the spans against doing it from decoded tokens.
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from ck2parser import SimpleParser, SimpleTokenizer
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+parser = SimpleParser()
+prefixes = {b'e_', b'k_', b'd_', b'c_', b'b_'}
+
+def from_tokens():
+    data = in_path.read_bytes()
+    return [value for type, value in
+            SimpleTokenizer.tokenize_bytes(data, parser.encoding)
+            if type == 'Name' and value[:2].encode() in prefixes]
+
+def from_spans():
+    with parser.token_spans(in_path) as tokens:
+        data = tokens.data
+        return [tokens.text(start, end) for type, start, end in tokens
+                if type == 'Name' and data[start:start + 2] in prefixes]
+
+def run(f):
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start, peak
+
+with parser.token_spans(in_path) as tokens:
+    actual = [(type, tokens.text(start, end)) for type, start, end in tokens]
+expected = list(SimpleTokenizer.tokenize_bytes(in_path.read_bytes(),
+                                               parser.encoding))
+for i, (x, y) in enumerate(zip(expected, actual)):
+    if x != y:
+        sys.exit('token {} differs: expected {}, got {}'.format(i, x, y))
+if len(expected) != len(actual):
+    sys.exit('token count differs: expected {}, got {}'.format(
+             len(expected), len(actual)))
+print('{} tokens identical'.format(len(actual)))
+
+token_names, token_time, token_peak = run(from_tokens)
+span_names, span_time, span_peak = run(from_spans)
+if token_names != span_names:
+    sys.exit('title names differ')
+print('{} title names'.format(len(span_names)))
+print('tokens: {:.2f} s, peak {:.1f} MB'.format(token_time, token_peak / 2**20))
+print('spans:  {:.2f} s, peak {:.1f} MB'.format(span_time, span_peak / 2**20))
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+# checks the single-pass scanners of SimpleTokenizer and FullTokenizer against
+# the funcparserlib lexers they replaced, token for token, and times both on
+# the simplebench input.
+
+import sys
+import time
+from pathlib import Path
+from ck2parser import SimpleTokenizer, FullTokenizer
+
+in_path = Path('test_input.txt') if len(sys.argv) < 2 else Path(sys.argv[1])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+
+for tokenizer in [SimpleTokenizer, FullTokenizer]:
+    name = tokenizer.__name__
+    start = time.perf_counter()
+    expected = [(t.type, t.value) for t in tokenizer.spec_tokenize(text)]
+    spec_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = list(tokenizer.tokenize(text))
+    scan_time = time.perf_counter() - start
+
+    for i, (x, y) in enumerate(zip(expected, actual)):
+        if x != y:
+            sys.exit('{} token {} differs: expected {}, got {}'.format(
+                     name, i, x, y))
+    if len(expected) != len(actual):
+        sys.exit('{} token count differs: expected {}, got {}'.format(
+                 name, len(expected), len(actual)))
+
+    print('{}: {} tokens identical'.format(name, len(actual)))
+    print('funcparserlib lexer: {:.2f} s'.format(spec_time))
+    print('scanner:             {:.2f} s ({:.1f}x)'.format(
+          scan_time, spec_time / scan_time))
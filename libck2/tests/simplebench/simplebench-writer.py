@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# checks FullParser's output for golden/writer-input.txt under each set of
+# formatting options against the golden files next to it, then times
+# writing out the simplebench input, a deeply nested object and long comment
+# blocks. --update rewrites the golden files from the current output instead
+# of checking them.
+
+import sys
+import time
+from pathlib import Path
+from ck2parser import FullParser
+
+golden_dir = Path(__file__).resolve().parent / 'golden'
+
+option_sets = {
+    'default': {},
+    'fq_keys': {'fq_keys': ['norse', 'swedish', 'danish', 'finnish', 'saxon']},
+    'no_fold_keys': {'no_fold_keys': ['OR', 'NOT'], 'no_fold_to_depth': 1},
+    'newlines_to_depth': {'newlines_to_depth': 1},
+    'chars_per_line': {'chars_per_line': 60},
+    'space_indents': {'tab_indents': False, 'indent_width': 4},
+}
+
+def make_parser(options):
+    parser = FullParser()
+    for name, value in options.items():
+        setattr(parser, name, value)
+    return parser
+
+args = sys.argv[1:]
+update = '--update' in args
+if update:
+    args.remove('--update')
+
+text = (golden_dir / 'writer-input.txt').read_text(encoding='cp1252')
+for name, options in option_sets.items():
+    parser = make_parser(options)
+    output = parser.parse(text).str(parser)
+    golden_path = golden_dir / 'writer-{}.txt'.format(name)
+    if update:
+        golden_path.write_bytes(output.encode('cp1252'))
+        continue
+    expected = golden_path.read_bytes().decode('cp1252')
+    if output != expected:
+        line = next(i for i, (x, y) in enumerate(zip(
+                    output.splitlines() + [None],
+                    expected.splitlines() + [None]), 1) if x != y)
+        sys.exit('{}: output differs from golden file at line {}'.format(
+                 name, line))
+    print('{}: identical'.format(name))
+if update:
+    sys.exit()
+
+in_path = Path('test_input.txt') if len(args) < 1 else Path(args[0])
+with in_path.open(encoding='cp1252', errors='ignore') as f:
+    text = f.read()
+for name, options in option_sets.items():
+    parser = make_parser(options)
+    tree = parser.parse(text)
+    start = time.perf_counter()
+    output = tree.str(parser)
+    print('{}: {:.2f} s, {} chars'.format(
+          name, time.perf_counter() - start, len(output)))
+
+# every level of single-pair objects tries to fold onto one line, which the
+# innermost pair is too long for
+for depth in [8, 16, 64]:
+    parser = FullParser()
+    tree = parser.parse('a = { ' * depth + 'b = ' + 'x' * 130 + ' }' * depth)
+    start = time.perf_counter()
+    output = tree.str(parser)
+    print('depth {}: {:.2f} s, {} chars'.format(
+          depth, time.perf_counter() - start, len(output)))
+
+# each comment block is tried as commented-out script
+lines = ['split off in 1.07', 'holder = 5', 'a = { b = c }', 'TODO check']
+blocks = ['\n'.join('\t# ' + lines[(i + j) % 4] for j in range(i % 40)) +
+          '\n\tkey{} = yes'.format(i) for i in range(300)]
+parser = FullParser()
+tree = parser.parse('root = {\n' + '\n'.join(blocks) + '\n}\n')
+start = time.perf_counter()
+output = tree.str(parser)
+print('comment blocks: {:.2f} s, {} chars'.format(
+      time.perf_counter() - start, len(output)))